@@ -0,0 +1,94 @@
+"""
+bench_classifiers.py: Throughput of the local `HashingClassifier`
+against the Cloud Natural Language path on synthetic labelled pages.
+
+    python -m benchmarks.bench_classifiers
+
+The remote path is only timed when credentials are available.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import contextlib
+import io
+import random
+import time
+
+from rftk.cloud_functions.services.classifiers import CloudClassifier, \
+    HashingClassifier, EXCEPTION_CATEGORY
+
+from .pages import WORDS
+
+
+CATEGORIES = [
+    "/Home & Garden/Home Improvement/Plumbing",
+    "/Home & Garden/HVAC & Climate Control",
+    "/Business & Industrial/Construction & Maintenance",
+    "/Beauty & Fitness/Fitness",
+    "/Beauty & Fitness/Face & Body Care/Hair Care",
+    "/Food & Drink/Restaurants",
+    "/Autos & Vehicles/Vehicle Repair & Maintenance",
+    "/Law & Government/Legal",
+    "/Health/Health Conditions",
+    "/Finance/Accounting & Auditing/Tax Preparation & Planning",
+]
+
+
+def make_corpus(n_docs=None, n_words=300, seed=0):
+    """Returns texts and labels; each category draws a third of its
+    words from its own vocabulary and the rest from shared words."""
+    rng = random.Random(seed)
+    vocabularies = [["{}{}".format(label.split("/")[-1][:4].lower(), i)
+                     for i in range(60)] for label in CATEGORIES]
+    texts = list()
+    labels = list()
+    for _ in range(n_docs):
+        c = rng.randrange(len(CATEGORIES))
+        words = [rng.choice(vocabularies[c]) if rng.random() < 0.33
+                 else rng.choice(WORDS) for _ in range(n_words)]
+        texts.append(" ".join(words))
+        labels.append(CATEGORIES[c])
+    return texts, labels
+
+
+def accuracy(results=None, labels=None):
+    hits = [max(result, key=result.get) == label
+            for result, label in zip(results, labels)]
+    return sum(hits) / float(len(hits))
+
+
+def main(n_train=2000, n_test=5000, n_remote=20):
+    train_texts, train_labels = make_corpus(n_docs=n_train, seed=0)
+    test_texts, test_labels = make_corpus(n_docs=n_test, seed=1)
+
+    start = time.time()
+    classifier = HashingClassifier().fit(texts=train_texts,
+                                         labels=train_labels)
+    print("local fit:      {:7.2f} s for {} docs"
+          .format(time.time() - start, n_train))
+
+    start = time.time()
+    for text in test_texts[:500]:
+        classifier.predict(text=text)
+    elapsed = time.time() - start
+    print("local predict:  {:7.0f} docs/s".format(500 / elapsed))
+
+    start = time.time()
+    results = classifier.predict_many(texts=test_texts)
+    elapsed = time.time() - start
+    print("local batch:    {:7.0f} docs/s, accuracy {:.3f}"
+          .format(n_test / elapsed, accuracy(results, test_labels)))
+
+    remote = CloudClassifier()
+    start = time.time()
+    # the classification routines print as they go
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = remote.predict_many(texts=test_texts[:n_remote])
+    elapsed = time.time() - start
+    if all(EXCEPTION_CATEGORY in result for result in results):
+        print("remote batch:   not available")
+    else:
+        print("remote batch:   {:7.1f} docs/s".format(n_remote / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+bench_extractors.py: Per-page extraction cost of the crawler extractors,
+comparing a tree walk per extractor with the single-pass DocumentIndex.
+
+    python -m benchmarks.bench_extractors
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import contextlib
+import io
+import re
+
+from bs4 import BeautifulSoup
+
+from rftk.cloud_functions.services import crawler_service as cs
+
+from .pages import make_page, time_it
+
+
+PHONE_R = r'(?:(?:\+?([1-9]|[0-9][0-9]|[0-9][0-9][0-9])' \
+          r'\s*(?:[.-]\s*)?)?(?:\(\s*([2-9]1[02-9]|[2-9][02-8]1|[2-9]' \
+          r'[02-8][02-9])\s*\)|([0-9][1-9]|[0-9]1[02-9]|[2-9][02-8]1|' \
+          r'[2-9][02-8][02-9]))\s*(?:[.-]\s*)?)?([2-9]1[02-9]|[2-9]' \
+          r'[02-9]1|[2-9][02-9]{2})\s*(?:[.-]\s*)?([0-9]{4})(?:\s*' \
+          r'(?:#|x\.?|ext\.?|extension)\s*(\d+))?'
+
+
+def extract_with_tree_walks(document=None):
+    """The extractors as they were before DocumentIndex: every one walks
+    the whole tree and `document.text` is rebuilt for each regex."""
+    plugin_r = r"""(?<=wp-content\/plugins\/)(.*?)(?=\/)"""
+    theme_r = r"""(?<=wp-content\/themes\/)(.*?)(?=\/)"""
+    re.findall(r"'<\S+?>'", document.text)
+    document.find_all("a", href=cs.is_email_link)
+    re.findall(PHONE_R, document.text)
+    document.find_all("a", href=cs.is_tel_link)
+    document.find_all("a", href=cs.is_social_link)
+    [re.findall(plugin_r, tag["href"])[0] for tag in
+     document.find_all("link", {"href": re.compile(plugin_r)})]
+    [re.findall(theme_r, tag["href"])[0] for tag in
+     document.find_all("link", {"href": re.compile(theme_r)})]
+    document.find("script", {"data-name": "static-context"})
+    document.find_all("a", href=True)
+    document.find_all(name="meta", attrs={"name": "keywords"})
+    document.find_all(name="meta", attrs={"name": "description"})
+    document.text
+
+
+def extract_with_index(document=None):
+    """The current extractors; the tree is walked once per page."""
+    # drop the cached index so every run pays for building it
+    vars(document).pop("_rftk_index", None)
+    cs.get_hrefs(document=document)
+    cs.get_wp_plugins(document=document)
+    cs.get_wp_themes(document=document)
+    cs.get_squarespace_context(document=document)
+    cs.get_all_links(document=document)
+    cs.get_keywords_and_description(document=document)
+    cs.get_document_index(document).text
+
+
+def main():
+    html = make_page()
+    document = BeautifulSoup(html, "html.parser")
+    print("page size: {:.0f} KB".format(len(html) / 1024.))
+    # the extractors print as they go
+    with contextlib.redirect_stdout(io.StringIO()):
+        before = time_it(lambda: extract_with_tree_walks(document))
+        after = time_it(lambda: extract_with_index(document))
+    print("tree walk per extractor: {:.1f} ms/page".format(before * 1e3))
+    print("single-pass index:       {:.1f} ms/page".format(after * 1e3))
+    print("speedup: {:.1f}x".format(before / after))
+
+
+if __name__ == "__main__":
+    main()
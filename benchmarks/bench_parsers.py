@@ -0,0 +1,58 @@
+"""
+bench_parsers.py: Parse + extract time per page for each html parser
+backend supported by `crawler_service.parse_html`.
+
+    python -m benchmarks.bench_parsers
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import contextlib
+import io
+
+from rftk.cloud_functions.services import crawler_service as cs
+
+from .pages import make_page, time_it
+
+
+BACKENDS = ["html.parser", "lxml", "selectolax"]
+
+
+def parse_and_extract(content=None, parser=None):
+    document = cs.parse_html(content=content, parser=parser)
+    cs.get_hrefs(document=document)
+    cs.get_wp_plugins(document=document)
+    cs.get_wp_themes(document=document)
+    cs.get_squarespace_context(document=document)
+    cs.get_all_links(document=document)
+    cs.get_keywords_and_description(document=document)
+    cs.get_document_index(document).text
+
+
+def main():
+    content = make_page().encode("utf-8")
+    print("page size: {:.0f} KB".format(len(content) / 1024.))
+    baseline = None
+    for parser in BACKENDS:
+        if parser == "selectolax" and cs.SelectolaxParser is None:
+            print("{:<12} not installed".format(parser))
+            continue
+        # the extractors print as they go
+        with contextlib.redirect_stdout(io.StringIO()):
+            try:
+                elapsed = time_it(
+                    lambda: parse_and_extract(content=content,
+                                              parser=parser))
+            except Exception as e:
+                elapsed = None
+                error = e
+        if elapsed is None:
+            print("{:<12} failed: {}".format(parser, error))
+            continue
+        if baseline is None:
+            baseline = elapsed
+        print("{:<12} {:6.1f} ms/page ({:.1f}x)"
+              .format(parser, elapsed * 1e3, baseline / elapsed))
+
+
+if __name__ == "__main__":
+    main()
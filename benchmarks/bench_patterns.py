@@ -0,0 +1,82 @@
+"""
+bench_patterns.py: Per-call cost of each extractor's regex when the
+pattern is rebuilt in the function (a string pattern looked up in the
+`re` cache, or compiled from scratch once the cache has been purged)
+versus the precompiled pattern from `patterns.py`.
+
+    python -m benchmarks.bench_patterns
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import re
+import timeit
+
+from rftk.cloud_functions.services import patterns
+
+from .pages import make_page
+
+
+README = ("=== Contact Form 7 ===\nContributors: takayukister\n"
+          "Tags: contact, form, contact form, feedback, email\n\n"
+          "== Description ==\n\nJust another contact form plugin.\n\n"
+          "== Installation ==\n")
+
+# (extractor, pattern, method, input)
+CASES = [
+    ("get_emails", patterns.EMAIL_TEXT_RE, "findall",
+     make_page(n_paragraphs=20, n_links=0)),
+    ("get_phones", patterns.PHONE_RE, "findall",
+     make_page(n_paragraphs=20, n_links=0)),
+    ("get_wp_plugins", patterns.WP_PLUGIN_RE, "search",
+     "https://acme.com/wp-content/plugins/contact-form-7/style.css"),
+    ("get_wp_themes", patterns.WP_THEME_RE, "search",
+     "https://acme.com/wp-content/themes/astra/style.css"),
+    ("get_squarespace_context", patterns.SQUARESPACE_CONTEXT_RE, "search",
+     'Static.SQUARESPACE_CONTEXT = {"templateId": "abc"};'),
+    ("get_external_links", patterns.EXTERNAL_LINK_RE, "findall",
+     "https://partner1.org/page?id=1"),
+    ("get_wp_plugin_info_online", patterns.README_NAME_RE, "search",
+     README),
+    ("get_wp_plugin_info_online", patterns.README_TAGS_RE, "search",
+     README),
+    ("get_wp_plugin_info_online", patterns.README_DESCRIPTION_RE,
+     "search", README),
+    ("get_email_provider", patterns.MX_PRIORITY_RE, "sub",
+     "10 aspmx.l.google.com."),
+    ("is_valid_email", patterns.EMAIL_RE, "match",
+     "first.last+tag@mail.example.co.uk"),
+    ("get_domain_from_email", patterns.EMAIL_DOMAIN_RE, "match",
+     "first.last@example.com"),
+]
+
+
+def per_call(fn=None, number=None):
+    """Returns the best time per call in microseconds."""
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    print("{:<26} {:>8} {:>10} {:>10} {:>10}"
+          .format("extractor", "method", "compile", "re cache",
+                  "compiled"))
+    for name, pattern, method, text in CASES:
+        args = ("", text) if method == "sub" else (text,)
+        compiled = getattr(pattern, method)
+        module = getattr(re, method)
+        source = pattern.pattern
+        # short inputs need more calls for a stable timing
+        number = 200 if len(text) > 1000 else 20000
+
+        def rebuilt():
+            re.purge()
+            return module(source, *args)
+
+        t_rebuilt = per_call(rebuilt, number=max(number // 100, 10))
+        t_cached = per_call(lambda: module(source, *args), number=number)
+        t_compiled = per_call(lambda: compiled(*args), number=number)
+        print("{:<26} {:>8} {:>8.2f}us {:>8.2f}us {:>8.2f}us"
+              .format(name, method, t_rebuilt, t_cached, t_compiled))
+
+
+if __name__ == "__main__":
+    main()
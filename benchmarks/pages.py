@@ -0,0 +1,64 @@
+"""
+pages.py: Synthetic pages and timing helpers shared by the benchmarks.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import random
+import time
+
+
+WORDS = ["plumbing", "heating", "repair", "service", "estimate", "local",
+         "family", "owned", "licensed", "insured", "emergency", "call",
+         "today", "quality", "customers", "award", "winning", "team"]
+
+
+def make_page(n_paragraphs=400, n_links=300, seed=0):
+    """Returns the html of a large marketing style homepage."""
+    rng = random.Random(seed)
+    head = [
+        "<html><head><title>Acme Plumbing</title>",
+        '<meta name="keywords" content="plumbing, heating, hvac">',
+        '<meta name="description" content="Family owned since 1952">',
+    ]
+    for i in range(25):
+        head.append('<link rel="stylesheet" href="https://acme.com/'
+                    'wp-content/plugins/plugin-{}/style.css">'.format(i))
+    head.append('<link rel="stylesheet" href="https://acme.com/'
+                'wp-content/themes/astra/style.css">')
+    head.append('<script data-name="static-context">'
+                'Static.SQUARESPACE_CONTEXT = {"templateId": "abc"};'
+                '</script>')
+    head.append("</head>")
+
+    body = ["<body>"]
+    for i in range(n_paragraphs):
+        words = " ".join(rng.choice(WORDS) for _ in range(40))
+        body.append("<div class='row'><p>{} call (555) 867-{:04d}</p>"
+                    "</div>".format(words, i))
+    for i in range(n_links):
+        kind = i % 5
+        if kind == 0:
+            href = "mailto:info{}@acme.com".format(i)
+        elif kind == 1:
+            href = "tel:555867{:04d}".format(i)
+        elif kind == 2:
+            href = "https://facebook.com/acme{}".format(i)
+        elif kind == 3:
+            href = "/services/{}".format(i)
+        else:
+            href = "https://partner{}.org/page?id={}".format(i, i)
+        body.append('<a href="{}">link {}</a>'.format(href, i))
+    body.append("</body></html>")
+    return "\n".join(head + body)
+
+
+def time_it(fn=None, repeat=5):
+    """Returns the best wall clock time of `repeat` runs of `fn`."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
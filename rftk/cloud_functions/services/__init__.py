@@ -4,13 +4,17 @@ RFTK: A python utility package for the Infusionsoft Refinery.
 __version__ = "0.6.51"
 __author__ = "Jason Wolosonovich <jason@avaland.io>"
 __license__ = "BSD 3 clause"
-from .classes import MetadataMixin
+import importlib
+
+from .classes import MetadataMixin, BatchedRowWriter, LatencyHistogram, \
+    TokenBucket, PublishStats
 
 from .functions import get_service_params, get_valid_url, \
-    upload_to_gcs, publish_to_endpoint, decode_event, encode_event, \
-    download_from_gcs, insert_one_to_bq, insert_many_to_bq, \
-    is_valid_email, get_domain_from_email, \
-    generate_refinery_id
+    upload_to_gcs, publish_to_endpoint, get_publisher, decode_event, \
+    encode_event, download_from_gcs, insert_one_to_bq, insert_many_to_bq, \
+    upload_many_to_gcs, download_many_from_gcs, \
+    is_valid_email, get_domain_from_email, are_valid_emails, \
+    get_domains_from_emails, generate_refinery_id, generate_refinery_ids
 
 from .schemas import MOBILE_FRIENDLY_SCHEMA, \
     WORDPRESS_ASSET_HISTORY_SCHEMA, \
@@ -23,7 +27,13 @@ from .schemas import MOBILE_FRIENDLY_SCHEMA, \
     APP_ENRICHMENT_ERROR_SCHEMA, WORDPRESS_ENRICHMENT_ERROR_SCHEMA, \
     LEAD_ENRICHMENT_ERROR_SCHEMA
 
-from .constants import MAX_RETRIES, SLEEP_LENGTH
+from .constants import MAX_RETRIES, SLEEP_LENGTH, HTTP_TIMEOUT
+
+from .sessions import get_session, close_sessions
+
+from .envelope import encode_message, decode_message
+
+from .rate_limits import AdaptiveRateLimiter, get_rate_limiter
 
 from .crawler_service import HEADERS
 
@@ -36,17 +46,49 @@ from .wordpress_lookup_service import get_wp_plugin_info_online
 from .email_provider_lookup_service import get_email_provider
 
 
+# name -> module of the exports that are only imported on first use, so
+# importing the package doesn't load numpy or asyncio for the services
+# that never use them
+_LAZY_EXPORTS = {
+    "crawl_batch": "crawl_engine",
+    "crawl_batch_async": "crawl_engine",
+    "PageCache": "caches",
+    "MemoryBackend": "caches",
+    "DiskBackend": "caches",
+    "SQLiteBackend": "caches",
+    "ClearbitCache": "caches",
+    "CloudClassifier": "classifiers",
+    "HashingClassifier": "classifiers",
+    "get_classifier": "classifiers"
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_EXPORTS:
+        raise AttributeError("module {!r} has no attribute {!r}"
+                             .format(__name__, name))
+    module = importlib.import_module("." + _LAZY_EXPORTS[name], __name__)
+    value = getattr(module, name)
+    globals()[name] = value
+    return value
+
+
 # NOTE: should follow the same versioning cadence as the_refinery
 __all__ = [
     "get_valid_url",
     "is_valid_email",
     "get_domain_from_email",
+    "are_valid_emails",
+    "get_domains_from_emails",
     "get_service_params",
     "upload_to_gcs",
     "download_from_gcs",
+    "upload_many_to_gcs",
+    "download_many_from_gcs",
     "decode_event",
     "encode_event",
     "generate_refinery_id",
+    "generate_refinery_ids",
     "MOBILE_FRIENDLY_SCHEMA",
     "WORDPRESS_ASSET_HISTORY_SCHEMA",
     "CLEARBIT_TECH_HISTORY_SCHEMA",
@@ -64,9 +106,30 @@ __all__ = [
     "WORDPRESS_ENRICHMENT_ERROR_SCHEMA",
     "LEAD_ENRICHMENT_ERROR_SCHEMA",
     "MetadataMixin",
+    "BatchedRowWriter",
+    "LatencyHistogram",
+    "TokenBucket",
+    "PublishStats",
     "MAX_RETRIES",
     "SLEEP_LENGTH",
+    "HTTP_TIMEOUT",
+    "get_session",
+    "close_sessions",
+    "encode_message",
+    "decode_message",
+    "AdaptiveRateLimiter",
+    "get_rate_limiter",
     "HEADERS",
+    "crawl_batch",
+    "crawl_batch_async",
+    "PageCache",
+    "MemoryBackend",
+    "DiskBackend",
+    "SQLiteBackend",
+    "ClearbitCache",
+    "CloudClassifier",
+    "HashingClassifier",
+    "get_classifier",
     "CLEARBIT_CONFIGS",
     "CRAWLER_CONFIGS",
     "MOBILE_CONFIGS",
@@ -78,4 +141,5 @@ __all__ = [
     "insert_one_to_bq",
     "insert_many_to_bq",
     "publish_to_endpoint",
+    "get_publisher",
 ]
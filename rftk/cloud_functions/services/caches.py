@@ -0,0 +1,350 @@
+"""
+caches.py: Cache backends and the caches built on them.
+
+Backends share a small interface (`get`, `set`, `delete`) and store
+JSON-serializable values with an optional per-entry ttl, so any cache
+can be moved between process memory, local disk and SQLite.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import copy
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+from cachetools import LRUCache
+
+from .classes import MetadataMixin
+from .constants import PAGE_CACHE_MAXSIZE, PAGE_CACHE_TTL, \
+    CLASSIFY_CACHE_MAXSIZE, CLASSIFY_CACHE_DIR, CLEARBIT_CACHE_BACKEND, \
+    CLEARBIT_CACHE_PATH, CLEARBIT_CACHE_MAXSIZE, CLEARBIT_CACHE_TTL, \
+    CLEARBIT_CACHE_NOT_FOUND_TTL
+
+
+class MemoryBackend(object):
+    """LRU cache held in process memory; survives warm starts."""
+    def __init__(self, maxsize=10000):
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def get(self, key=None):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.time():
+                del self._cache[key]
+                return None
+            return value
+
+    def set(self, key=None, value=None, ttl=None):
+        expires_at = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._cache[key] = (expires_at, value)
+
+    def delete(self, key=None):
+        with self._lock:
+            self._cache.pop(key, None)
+
+
+class DiskBackend(object):
+    """Stores each entry as a JSON file in `directory`."""
+    def __init__(self, directory=None):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key=None):
+        name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".json")
+
+    def get(self, key=None):
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["expires_at"] is not None and \
+                entry["expires_at"] < time.time():
+            self.delete(key)
+            return None
+        return entry["value"]
+
+    def set(self, key=None, value=None, ttl=None):
+        expires_at = None if ttl is None else time.time() + ttl
+        path = self._path(key)
+        # write then rename so readers never see a partial file; the
+        # directory may be shared by several processes
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(),
+                                         threading.get_ident())
+        with open(tmp_path, "w") as f:
+            json.dump({"expires_at": expires_at, "value": value}, f)
+        os.replace(tmp_path, path)
+
+    def delete(self, key=None):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+
+class SQLiteBackend(object):
+    """Stores the entries in a local SQLite database, which the
+    processes on a machine can share."""
+    def __init__(self, path=None):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30,
+                                     check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, expires_at REAL, value TEXT)"
+            )
+
+    def get(self, key=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at, value FROM cache WHERE key = ?",
+                (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        expires_at, value = row
+        if expires_at is not None and expires_at < time.time():
+            self.delete(key)
+            return None
+        return json.loads(value)
+
+    def set(self, key=None, value=None, ttl=None):
+        expires_at = None if ttl is None else time.time() + ttl
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
+                (key, expires_at, json.dumps(value))
+            )
+
+    def delete(self, key=None):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+def get_cache_backend(name="memory", path=None, maxsize=10000):
+    """Utility function that returns a backend by name: "memory",
+    "disk" (`path` is a directory) or "sqlite" (`path` is the database
+    file)."""
+    if name == "memory":
+        return MemoryBackend(maxsize=maxsize)
+    if name in ("disk", "sqlite") and path is None:
+        raise ValueError("the {} cache backend requires a `path` "
+                         "(RFTK_CLEARBIT_CACHE_PATH)".format(name))
+    if name == "disk":
+        return DiskBackend(directory=path)
+    if name == "sqlite":
+        return SQLiteBackend(path=path)
+    raise ValueError("unknown cache backend: {}".format(name))
+
+
+class TieredCache(object):
+    """Memory LRU in front of an optional disk tier. Entries found on
+    disk are promoted to memory."""
+    def __init__(self, maxsize=10000, directory=None, ttl=None):
+        self.memory = MemoryBackend(maxsize=maxsize)
+        self.disk = None if directory is None else \
+            DiskBackend(directory=directory)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key=None):
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.set(key, value, ttl=self.ttl)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key=None, value=None, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.memory.set(key, value, ttl=ttl)
+        if self.disk is not None:
+            self.disk.set(key, value, ttl=ttl)
+
+    def delete(self, key=None):
+        self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete(key)
+
+
+class ClassificationCache(TieredCache):
+    """Category->confidence maps keyed by the sha256 of the normalized
+    text that was classified. Set `RFTK_CLASSIFY_CACHE_DIR` to keep a
+    disk tier across cold starts."""
+    def __init__(self, maxsize=CLASSIFY_CACHE_MAXSIZE,
+                 directory=CLASSIFY_CACHE_DIR, ttl=None):
+        super(ClassificationCache, self).__init__(maxsize=maxsize,
+                                                  directory=directory,
+                                                  ttl=ttl)
+
+    @staticmethod
+    def get_key(text=None):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def normalize_url(url=None):
+    """Utility function that normalizes the url for use as a cache key:
+    lowercase scheme and host, no default port, no fragment and a
+    non-empty path."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port is not None and \
+            (scheme, parts.port) not in (("http", 80), ("https", 443)):
+        host = "{}:{}".format(host, parts.port)
+    path = parts.path or "/"
+    return urlunsplit((scheme, host, path, parts.query, ""))
+
+
+class PageCache(object):
+    """Content-addressed cache of crawled pages keyed by normalized url.
+
+    Each entry holds the sha256 of the body, the validators needed for
+    a conditional GET (ETag/Last-Modified) and the extraction results
+    derived from the page, so an unchanged page never has to be parsed
+    or classified again."""
+    def __init__(self, backend=None, ttl=PAGE_CACHE_TTL):
+        self.backend = MemoryBackend(maxsize=PAGE_CACHE_MAXSIZE) \
+            if backend is None else backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url=None):
+        """Returns the cached entry for the url, if any."""
+        return self.backend.get(normalize_url(url))
+
+    def get_conditional_headers(self, url=None):
+        """Returns the If-None-Match/If-Modified-Since headers for a
+        conditional GET of the url."""
+        entry = self.get(url)
+        headers = dict()
+        if entry is None:
+            return headers
+        if entry.get("etag") is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified") is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def set(self, url=None, html_sha256=None, etag=None,
+            last_modified=None, results=None):
+        """Caches the page's digest, validators and results."""
+        self.backend.set(
+            normalize_url(url),
+            MetadataMixin(
+                url=url,
+                html_sha256=html_sha256,
+                etag=etag,
+                last_modified=last_modified,
+                results=results,
+                cached_at=time.time()
+            ),
+            ttl=self.ttl
+        )
+
+    def get_unchanged(self, url=None, status_code=None,
+                      html_sha256=None):
+        """Returns the cached entry if the response shows the page
+        hasn't changed (a 304 or the same body digest), else None."""
+        entry = self.get(url)
+        if entry is not None and \
+                (status_code == 304 or
+                 (html_sha256 is not None and
+                  entry["html_sha256"] == html_sha256)):
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+
+class ClearbitCache(object):
+    """Clearbit responses keyed by endpoint, API-Version and the lookup
+    parameters. Matches are kept for `ttl` seconds and "not found"
+    results for `not_found_ttl`; every hit is a request, and quota,
+    saved on that endpoint.
+
+    Without a `backend` the one configured by `RFTK_CLEARBIT_CACHE_*`
+    is opened on first use, so nothing is opened at import."""
+    def __init__(self, backend=None, ttl=CLEARBIT_CACHE_TTL,
+                 not_found_ttl=CLEARBIT_CACHE_NOT_FOUND_TTL):
+        self._backend = backend
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.hits = 0
+        self.misses = 0
+        # endpoint -> requests answered from the cache
+        self.saved = dict()
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = get_cache_backend(
+                        name=CLEARBIT_CACHE_BACKEND,
+                        path=CLEARBIT_CACHE_PATH,
+                        maxsize=CLEARBIT_CACHE_MAXSIZE
+                    )
+        return self._backend
+
+    @staticmethod
+    def get_key(endpoint=None, api_version=None, email=None, domain=None,
+                ip_address=None):
+        email = None if email is None else email.strip().lower()
+        domain = None if domain is None else domain.strip().lower()
+        return json.dumps([endpoint, api_version, email, domain,
+                           ip_address])
+
+    def get(self, key=None, endpoint=None):
+        """Returns a copy of the cached response, if any."""
+        value = self.backend.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.saved[endpoint] = self.saved.get(endpoint, 0) + 1
+        # callers annotate the responses they're given
+        return copy.deepcopy(value)
+
+    def set(self, key=None, resp=None, status_code=None):
+        """Caches a 200 match or a 404 "not found" result; anything
+        else (errors, lookups still pending) is left out."""
+        if status_code == 200 and "error" not in resp and \
+                "pending" not in resp:
+            ttl = self.ttl
+        elif status_code == 404:
+            ttl = self.not_found_ttl
+        else:
+            return False
+        self.backend.set(key, resp, ttl=ttl)
+        return True
+
+    def get_stats(self):
+        """Returns the hit counts and the requests saved per
+        endpoint."""
+        with self._lock:
+            return MetadataMixin(hits=self.hits,
+                                 misses=self.misses,
+                                 saved=dict(self.saved))
@@ -3,9 +3,15 @@ classes.py: utility classes used in the the Refinery.
 
 """
 import json
+import math
+import threading
+import time
 
 from googleapiclient.discovery_cache.base import Cache as GoogleCache
 
+from .constants import BQ_MAX_RETRIES, BQ_MAX_ROWS_PER_BATCH, \
+    BQ_MAX_BYTES_PER_BATCH
+
 __author__ = "Jason Wolosonovich <jason@avaland.io>"
 __license__ = "BSD 3 clause"
 
@@ -22,6 +28,22 @@ class MetadataMixin(dict):
                           indent=2)
 
 
+class PublishStats(MetadataMixin):
+    """The stats returned by `publish_to_endpoint`. Compares equal to
+    its `status` string, so callers that check the result against
+    "OK, 200", as it used to be returned, keep working."""
+    def __eq__(self, other):
+        if isinstance(other, str):
+            return self.get("status") == other
+        return super(PublishStats, self).__eq__(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+
 class MemoryCache(GoogleCache):
     """Avoids the warning about the file_cache being unavailable."""
     _CACHE = {}
@@ -31,3 +53,255 @@ class MemoryCache(GoogleCache):
 
     def set(self, url, content):
         MemoryCache._CACHE[url] = content
+
+
+class BatchedRowWriter(object):
+    """Buffers rows bound for BigQuery and streams them with
+    `insert_rows` in batches bounded by row count and request size.
+
+    Rows are buffered per table so a single writer can be shared by
+    every payload handled during an invocation; call `flush()` before
+    the function returns to send whatever is left in the buffers."""
+    def __init__(self, bq_client=None, max_rows=BQ_MAX_ROWS_PER_BATCH,
+                 max_bytes=BQ_MAX_BYTES_PER_BATCH,
+                 max_retries=BQ_MAX_RETRIES):
+        self.bq_client = bq_client
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        # table_id -> {"table", "schema", "rows", "n_bytes"}
+        self._buffers = {}
+        self.rows_sent = 0
+        self.rows_failed = 0
+        self.batches_sent = 0
+        self.seconds_inserting = 0.0
+
+    @staticmethod
+    def _table_id(table=None):
+        return "{}.{}.{}".format(table.project,
+                                 table.dataset_id,
+                                 table.table_id)
+
+    @staticmethod
+    def _row_size(row=None):
+        # rough size of the row once serialized into the request body
+        return len(json.dumps(row, default=str)) + 32
+
+    def add_rows(self, table=None, schema=None, rows=None):
+        """Adds rows to the table's buffer, sending a batch whenever
+        the buffer reaches one of the batch limits."""
+        table_id = self._table_id(table)
+        if table_id not in self._buffers:
+            self._buffers[table_id] = {
+                "table": table,
+                "schema": schema,
+                "rows": list(),
+                "n_bytes": 0
+            }
+        buffer = self._buffers[table_id]
+
+        for row in rows:
+            row_size = self._row_size(row)
+            if len(buffer["rows"]) != 0 and \
+                    (len(buffer["rows"]) >= self.max_rows or
+                     buffer["n_bytes"] + row_size > self.max_bytes):
+                self._send_buffer(buffer)
+            buffer["rows"].append(row)
+            buffer["n_bytes"] += row_size
+
+    def flush(self):
+        """Sends every buffered row and returns whether all rows sent
+        by this writer so far were inserted."""
+        print("BatchedRowWriter.flush()")
+        for buffer in self._buffers.values():
+            if len(buffer["rows"]) != 0:
+                self._send_buffer(buffer)
+        print("stats: {}".format(self.get_stats()))
+        return self.rows_failed == 0
+
+    def _send_buffer(self, buffer=None):
+        rows = buffer["rows"]
+        buffer["rows"] = list()
+        buffer["n_bytes"] = 0
+        self._insert_batch(table=buffer["table"],
+                           schema=buffer["schema"],
+                           rows=rows)
+
+    def _insert_batch(self, table=None, schema=None, rows=None):
+        """Inserts a batch, retrying only the rows BigQuery reports as
+        failed."""
+        start = time.time()
+        for n in range(self.max_retries):
+            try:
+                errors = self.bq_client.insert_rows(
+                    table,
+                    rows,
+                    selected_fields=schema
+                )
+                self.batches_sent += 1
+            except Exception as e:
+                if n == self.max_retries - 1:
+                    print(e)
+                    break
+                time.sleep(2 ** n)
+                continue
+
+            self.rows_sent += len(rows) - len(errors)
+            if len(errors) == 0:
+                rows = list()
+                break
+
+            print(errors)
+            # rows rejected as invalid will never succeed; the rest were
+            # only stopped because they shared a request with them
+            retry_rows = list()
+            for error in errors:
+                reasons = [e.get("reason") for e in error["errors"]]
+                if "invalid" in reasons:
+                    self.rows_failed += 1
+                    continue
+                retry_rows.append(rows[error["index"]])
+            rows = retry_rows
+            if len(rows) == 0:
+                break
+            if n != self.max_retries - 1:
+                time.sleep(2 ** n)
+
+        self.rows_failed += len(rows)
+        self.seconds_inserting += time.time() - start
+
+    def get_stats(self):
+        """Returns the throughput of the writer."""
+        elapsed = max(self.seconds_inserting, 1e-6)
+        return MetadataMixin(
+            rows_sent=self.rows_sent,
+            rows_failed=self.rows_failed,
+            batches_sent=self.batches_sent,
+            seconds_inserting=round(self.seconds_inserting, 3),
+            rows_per_second=round(self.rows_sent / elapsed, 1),
+            batches_per_second=round(self.batches_sent / elapsed, 1)
+        )
+
+
+class LatencyHistogram(object):
+    """Thread-safe histogram of latencies in seconds.
+
+    Samples are counted in log-spaced buckets (each `growth` times wider
+    than the last, starting at `min_latency`), so memory stays constant
+    however many samples are recorded and percentiles are accurate to
+    within a bucket."""
+    def __init__(self, min_latency=1e-4, growth=1.05):
+        self.min_latency = min_latency
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def _bucket(self, latency=None):
+        if latency <= self.min_latency:
+            return 0
+        return int(math.log(latency / self.min_latency) /
+                   self._log_growth) + 1
+
+    def record(self, latency=None):
+        """Records a single latency in seconds."""
+        bucket = self._bucket(latency)
+        with self._lock:
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.total += latency
+            self.max = max(self.max, latency)
+
+    def percentile(self, q=None):
+        """Returns the upper bound of the bucket holding the q-th
+        percentile (0-100), or None if nothing has been recorded."""
+        with self._lock:
+            if self.count == 0:
+                return None
+            rank = q / 100. * self.count
+            seen = 0
+            for bucket in sorted(self._buckets):
+                seen += self._buckets[bucket]
+                if seen >= rank:
+                    break
+            upper = self.min_latency * self.growth ** bucket
+            return min(upper, self.max)
+
+    def get_stats(self):
+        """Returns the count, mean, max and the p50/p90/p99 latencies in
+        seconds."""
+        stats = MetadataMixin(
+            count=self.count,
+            mean=None,
+            p50=None,
+            p90=None,
+            p99=None,
+            max=None
+        )
+        if self.count != 0:
+            stats["mean"] = round(self.total / self.count, 4)
+            stats["p50"] = round(self.percentile(50), 4)
+            stats["p90"] = round(self.percentile(90), 4)
+            stats["p99"] = round(self.percentile(99), 4)
+            stats["max"] = round(self.max, 4)
+        return stats
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket refilled at `rate` tokens per second and
+    holding at most `capacity` tokens (one second's worth by default).
+
+    `reserve` takes the tokens straight away, going into debt when there
+    aren't enough, and returns how long the caller should wait; async
+    callers can `await asyncio.sleep()` on it rather than block.
+    `acquire` sleeps for that long in the calling thread."""
+    def __init__(self, rate=None, capacity=None):
+        self.rate = float(rate)
+        self.capacity = self.rate if capacity is None else float(capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.waited = 0
+        self.seconds_waited = 0.0
+        self.waits = LatencyHistogram()
+
+    def reserve(self, amount=1):
+        """Takes `amount` tokens and returns the seconds to wait before
+        using them."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= amount
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+            self.acquired += 1
+            if wait > 0:
+                self.waited += 1
+                self.seconds_waited += wait
+        self.waits.record(wait)
+        return wait
+
+    def acquire(self, amount=1):
+        """Blocks until `amount` tokens are available. Returns the
+        seconds waited."""
+        wait = self.reserve(amount=amount)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def get_stats(self):
+        """Returns how often and for how long callers waited."""
+        return MetadataMixin(
+            rate=self.rate,
+            acquired=self.acquired,
+            waited=self.waited,
+            seconds_waited=round(self.seconds_waited, 3),
+            wait=self.waits.get_stats()
+        )
@@ -0,0 +1,211 @@
+"""
+classifiers.py: Content classifiers for crawled pages.
+
+Every classifier returns the same category->confidence maps as
+`crawler_service.get_content_class`, with the categories given as
+/tier1/tier2/tier3 paths, so the crawler payloads are flattened the
+same way whichever one produced them.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import threading
+import zlib
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from .constants import CLASSIFIER, CLASSIFIER_MODEL_PATH, \
+    CLASSIFIER_N_FEATURES, CLASSIFIER_MIN_SCORE, CLASSIFIER_TOP_K, \
+    CLASSIFIER_MAX_CELLS
+from .crawler_service import get_content_class, classify_many, \
+    normalize_text
+from .patterns import TOKEN_RE
+
+
+NO_CATEGORY = "No Category Available"
+EXCEPTION_CATEGORY = "An Exception Occurred"
+
+# loaded models are kept for the life of the process
+_CLASSIFIERS = dict()
+_CLASSIFIERS_LOCK = threading.Lock()
+
+
+class Classifier(ABC):
+    """Interface shared by the content classifiers. Subclasses
+    implement `predict_many`."""
+    def predict(self, text=None):
+        """Returns the category->confidence map for a single text."""
+        return self.predict_many(texts=[text])[0]
+
+    @abstractmethod
+    def predict_many(self, texts=None):
+        """Returns a category->confidence map for each text, in
+        order."""
+
+
+class CloudClassifier(Classifier):
+    """Cloud Natural Language, through `get_content_class` and
+    `classify_many`. Texts the API fails on are passed to the
+    `fallback` classifier when one is given."""
+    def __init__(self, fallback=None):
+        self.fallback = fallback
+
+    def predict(self, text=None):
+        result = get_content_class(content=text)
+        if EXCEPTION_CATEGORY in result and self.fallback is not None:
+            result = self.fallback.predict(text=text)
+        return result
+
+    def predict_many(self, texts=None):
+        results = classify_many(contents=texts)
+        if self.fallback is not None:
+            failed = [i for i, result in enumerate(results)
+                      if EXCEPTION_CATEGORY in result]
+            if len(failed) != 0:
+                fallbacks = self.fallback.predict_many(
+                    texts=[texts[i] for i in failed])
+                for i, result in zip(failed, fallbacks):
+                    results[i] = result
+        return results
+
+
+class HashingClassifier(Classifier):
+    """Local nearest-centroid classifier over hashed term frequencies.
+
+    Tokens are hashed into `n_features` buckets, weighted by sublinear
+    term frequency and l2 normalized; each category is the normalized
+    mean of its training documents and a page's confidence in a
+    category is its cosine similarity to the centroid. Needs no network
+    and classifies thousands of pages a second."""
+    def __init__(self, n_features=CLASSIFIER_N_FEATURES,
+                 min_score=CLASSIFIER_MIN_SCORE, top_k=CLASSIFIER_TOP_K):
+        self.n_features = n_features
+        self.min_score = min_score
+        self.top_k = top_k
+        self.labels = list()
+        # (n_features, n_labels)
+        self.centroids = None
+
+    def _vectorize(self, texts=None):
+        """Returns the (doc, feature, weight) triplets for the texts,
+        sorted by doc."""
+        n_features = self.n_features
+        buckets = dict()
+        keys = list()
+        for i, text in enumerate(texts):
+            offset = i * n_features
+            for token in TOKEN_RE.findall(normalize_text(text).lower()):
+                bucket = buckets.get(token)
+                if bucket is None:
+                    bucket = zlib.crc32(token.encode("utf-8")) % n_features
+                    buckets[token] = bucket
+                keys.append(offset + bucket)
+
+        keys, counts = np.unique(np.asarray(keys, dtype=np.int64),
+                                 return_counts=True)
+        docs = keys // n_features
+        features = keys % n_features
+        weights = 1.0 + np.log(counts)
+        norms = np.sqrt(np.bincount(docs,
+                                    weights=weights * weights,
+                                    minlength=len(texts)))
+        weights /= norms[docs]
+        return docs, features, weights.astype(np.float32)
+
+    def fit(self, texts=None, labels=None):
+        """Fits one centroid per category path in `labels`."""
+        self.labels = sorted(set(labels))
+        index = {label: i for i, label in enumerate(self.labels)}
+        label_ids = np.array([index[label] for label in labels],
+                             dtype=np.int64)
+        docs, features, weights = self._vectorize(texts=texts)
+        centroids = np.bincount(
+            label_ids[docs] * self.n_features + features,
+            weights=weights,
+            minlength=len(self.labels) * self.n_features
+        ).reshape(len(self.labels), self.n_features)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        self.centroids = np.ascontiguousarray(
+            (centroids / norms).T.astype(np.float32))
+        return self
+
+    def score_many(self, texts=None):
+        """Returns the (n_texts, n_labels) matrix of cosine
+        similarities."""
+        docs, features, weights = self._vectorize(texts=texts)
+        n_labels = len(self.labels)
+        scores = np.zeros((len(texts), n_labels), dtype=np.float32)
+        if len(docs) == 0:
+            return scores
+        starts = np.flatnonzero(np.r_[True, docs[1:] != docs[:-1]])
+        ends = np.r_[starts[1:], len(docs)]
+        # gather the centroid rows for as many docs at a time as fit in
+        # `CLASSIFIER_MAX_CELLS`
+        max_rows = max(CLASSIFIER_MAX_CELLS // max(n_labels, 1), 1)
+        first = 0
+        while first < len(starts):
+            last = first + 1
+            while last < len(starts) and \
+                    ends[last] - starts[first] <= max_rows:
+                last += 1
+            lo, hi = starts[first], ends[last - 1]
+            rows = self.centroids[features[lo:hi]] * \
+                weights[lo:hi, None]
+            scores[docs[starts[first:last]]] = np.add.reduceat(
+                rows, starts[first:last] - lo, axis=0)
+            first = last
+        return scores
+
+    def predict_many(self, texts=None):
+        scores = self.score_many(texts=texts)
+        results = list()
+        for row in scores:
+            top = np.argsort(row)[::-1][:self.top_k]
+            result = {self.labels[i]: round(float(row[i]), 4)
+                      for i in top if row[i] >= self.min_score}
+            if len(result) == 0:
+                result[NO_CATEGORY] = 0.0
+            results.append(result)
+        return results
+
+    def save(self, path=None):
+        """Saves the fitted model as a compressed `.npz` file."""
+        np.savez_compressed(path,
+                            centroids=self.centroids,
+                            labels=np.array(self.labels),
+                            n_features=self.n_features)
+
+    @classmethod
+    def load(cls, path=None, **kwargs):
+        """Loads a model saved by `save`."""
+        with np.load(path) as model:
+            classifier = cls(n_features=int(model["n_features"]),
+                             **kwargs)
+            classifier.labels = [str(label) for label in model["labels"]]
+            classifier.centroids = model["centroids"]
+        return classifier
+
+
+def get_classifier(name=CLASSIFIER, model_path=CLASSIFIER_MODEL_PATH):
+    """Utility function that returns the process-wide classifier:
+    "cloud", "local" or "cloud+local" (cloud with the local model as
+    the fallback)."""
+    if name in ("local", "cloud+local") and model_path is None:
+        raise ValueError("the {} classifier needs a model; set "
+                         "RFTK_CLASSIFIER_MODEL to the path of a model "
+                         "saved by HashingClassifier.save".format(name))
+    key = (name, model_path)
+    with _CLASSIFIERS_LOCK:
+        if key not in _CLASSIFIERS:
+            if name == "cloud":
+                classifier = CloudClassifier()
+            elif name == "local":
+                classifier = HashingClassifier.load(path=model_path)
+            elif name == "cloud+local":
+                classifier = CloudClassifier(
+                    fallback=HashingClassifier.load(path=model_path))
+            else:
+                raise ValueError("unknown classifier: {}".format(name))
+            _CLASSIFIERS[key] = classifier
+    return _CLASSIFIERS[key]
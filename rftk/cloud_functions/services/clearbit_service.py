@@ -5,15 +5,89 @@ __author__ = "Jason Wolosonovich <jason@avaland.io>"
 __license__ = "BSD 3 clause"
 import os
 import base64
+import heapq
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import requests
-import googleapiclient.discovery
 import clearbit
-import gcsfs
 
-from .classes import MemoryCache, MetadataMixin
-from .constants import MAX_RETRIES, SLEEP_LENGTH
+from .caches import ClearbitCache, MemoryBackend
+from .classes import MemoryCache, MetadataMixin, LatencyHistogram
+from .constants import MAX_RETRIES, SLEEP_LENGTH, HTTP_TIMEOUT, \
+    CLEARBIT_STREAMING_TIMEOUT, CLEARBIT_MAX_WORKERS, \
+    CLEARBIT_LATENCY_PERCENTILE, CLEARBIT_STREAMING_LATENCY_PRIOR, \
+    SECRETS_TTL, SECRETS_CACHE_MAXSIZE
+from .rate_limits import get_rate_limiter
+from .sessions import get_session, get_fs_client
+
+
+# endpoint -> (url, streaming url, API-Version)
+CLEARBIT_APIS = {
+    "reveal": ("https://reveal.clearbit.com/v1/companies/find",
+               # TODO: find out if there is a streaming endpoint for
+               #  Reveal
+               None,
+               "2018-03-28"),
+    "person": ("https://person.clearbit.com/v2/combined/find",
+               "https://person-stream.clearbit.com/v2/combined/find",
+               "2018-11-19"),
+    "company": ("https://company.clearbit.com/v2/companies/find",
+                "https://company-stream.clearbit.com/v2/companies/find",
+                "2017-09-12")
+}
+
+# status -> error message of the payloads returned for failed lookups
+CLEARBIT_ERRORS = {
+    "400": "Bad Request",
+    "401": "Invalid API Key",
+    "402": "Quota Exceeded",
+    "404": "Person/Company Not Found",
+    "422": "Unprocessable Entity",
+    "429": "Client Error: Too Many Requests",
+    "5xx": "Internal Server Error",
+    # not from clearbit: the caller's latency budget ran out
+    "timeout": "Latency Budget Exceeded",
+    # not from clearbit: the request raised (connection reset, bad json)
+    "error": "An Exception Occurred"
+}
+
+# responses are kept for the life of the process (or longer with the
+# disk/sqlite backends)
+CLEARBIT_CACHE = ClearbitCache()
+
+# clients and decrypted secrets are kept for the life of the process so
+# warm starts skip the gcs read and the kms round trip
+_KMS_CLIENT = None
+_CLIENTS_LOCK = threading.Lock()
+SECRETS_CACHE = MemoryBackend(maxsize=SECRETS_CACHE_MAXSIZE)
+
+# mode -> end-to-end latency of the lookups sent in that mode
+CLEARBIT_LATENCY = {
+    "streaming": LatencyHistogram(),
+    "polling": LatencyHistogram()
+}
+
+
+def get_kms_client():
+    """Utility function that returns the process-wide KMS client,
+    building it on first use."""
+    global _KMS_CLIENT
+    with _CLIENTS_LOCK:
+        if _KMS_CLIENT is None:
+            # imported here as it's slow to import and only needed when
+            # a secret isn't cached
+            import googleapiclient.discovery
+            _KMS_CLIENT = googleapiclient\
+                .discovery \
+                .build(
+                "cloudkms",
+                "v1",
+                cache=MemoryCache()
+            )
+    return _KMS_CLIENT
+
 
 
 def decrypt_with_kms(project_id=None, location_id=None,
@@ -21,14 +95,8 @@ def decrypt_with_kms(project_id=None, location_id=None,
                      ciphertext_string=None):
     """Decrypts data from ciphertext_string stored in GCS."""
     print("decrypt_with_kms()")
-    # Creates an API client for the KMS API.
-    kms_client = googleapiclient\
-        .discovery \
-        .build(
-        "cloudkms",
-        "v1",
-        cache=MemoryCache()
-    )
+    # Reuses the API client for the KMS API.
+    kms_client = get_kms_client()
 
     # The resource name of the CryptoKey.
     name = \
@@ -71,9 +139,36 @@ def decrypt_with_kms(project_id=None, location_id=None,
     return plaintext
 
 
+def get_secret(project_id=None, location_id=None, key_ring_id=None,
+               crypto_key_id=None, bucket_name=None, blob_name=None,
+               project_name=None, ttl=SECRETS_TTL):
+    """Utility function that returns the secret encrypted in
+    `bucket_name/blob_name`. The plaintext is cached for `ttl` seconds
+    and read and decrypted again once it expires, so rotated keys are
+    picked up."""
+    print("get_secret()")
+    key = "/".join([project_id, location_id, key_ring_id, crypto_key_id,
+                    bucket_name, blob_name])
+    secret = SECRETS_CACHE.get(key)
+    print("secret_cached: {}".format(secret is not None))
+    if secret is None:
+        fs = get_fs_client(project_name=project_name)
+        cipher_string = fs.cat(bucket_name + "/" + blob_name)
+        secret = decrypt_with_kms(
+            project_id=project_id,
+            location_id=location_id,
+            key_ring_id=key_ring_id,
+            crypto_key_id=crypto_key_id,
+            ciphertext_string=cipher_string
+        )
+        SECRETS_CACHE.set(key, secret, ttl=ttl)
+    return secret
+
+
 def get_service_configs(service=None, project_name=None):
     """Utility function to set configurations for the service."""
     print("get_service_configs()")
+    start = time.time()
     if service == "clearbit":
         try:
             # set configs from the env vars of the machine
@@ -94,21 +189,6 @@ def get_service_configs(service=None, project_name=None):
             # # not in use
             # clearbit.Prospector.set_version("2016-10-04")
 
-            fs = gcsfs.GCSFileSystem(
-                project=project_name,
-                access="full_control",
-                token="cloud",
-                # consistency="md5",
-                cache_timeout=None,
-                secure_serialize=True,
-                check_connection=True
-            )
-
-            fs.retries = 7
-            fs.connect(method="cloud")
-
-            cipher_string = fs.cat(BUCKET_NAME + "/" + CIPHERTEXT_BLOB)
-
             # DEPRECATED
             # download the file as a string in-memory
             # st_client = storage.Client()
@@ -116,15 +196,19 @@ def get_service_configs(service=None, project_name=None):
             # cipher_blob = bucket.blob(CIPHERTEXT_BLOB)
             # cipher_string = cipher_blob.download_as_string()
 
-            # decrypt the kms key stored in gcs and set the key attr
-            clearbit.key = decrypt_with_kms(
+            # decrypt the kms key stored in gcs (or reuse the cached
+            # plaintext) and set the key attr
+            clearbit.key = get_secret(
                 project_id=PROJECT_ID,
                 location_id=LOCATION_ID,
                 key_ring_id=KEYRING_ID,
                 crypto_key_id=CRYPTO_KEY_ID,
-                ciphertext_string=cipher_string
+                bucket_name=BUCKET_NAME,
+                blob_name=CIPHERTEXT_BLOB,
+                project_name=project_name
             )
             print("configs_set: True")
+            print("configs_seconds: {:.3f}".format(time.time() - start))
         # catch-all
         except Exception as e:
             print("config_set: False")
@@ -539,67 +623,347 @@ def check_clearbit_rate_limit(response=None):
     return results
 
 
-def clearbit_routines(request=None, streaming=False):
-    """Enrichment routines that wrap the Clearbit API."""
+def get_clearbit_endpoint(request=None):
+    """Utility function that returns the Clearbit API a request is for:
+    "reveal", "person" or "company" (None if it asks for neither)."""
+    if request["clearbit_reveal"] is True:
+        return "reveal"
+    if request["clearbit_enrich"] is True:
+        # TODO: NOTE: big "gotcha" here as the email address takes
+        #  precedent over the domain if provided
+        return "person" if request["email"] is not None else "company"
+    return None
+
+
+def choose_clearbit_mode(endpoint=None, streaming="auto",
+                         latency_budget=None):
+    """Utility function that returns "streaming" or "polling" for a
+    lookup.
+
+    The streaming endpoints hold the request open until the lookup is
+    done, so there's no 202 to poll for, but a slow lookup holds the
+    caller for up to the streaming read timeout. With `streaming="auto"`
+    a lookup streams unless its `latency_budget` (seconds) is smaller
+    than the streaming latency at `CLEARBIT_LATENCY_PERCENTILE`
+    (`CLEARBIT_STREAMING_LATENCY_PRIOR` until streaming lookups have
+    been timed); polling
+    returns a pending result within the budget instead. Reveal has no
+    streaming endpoint and always polls."""
+    if CLEARBIT_APIS[endpoint][1] is None or streaming is False:
+        return "polling"
+    if streaming is True or latency_budget is None:
+        return "streaming"
+    expected = CLEARBIT_LATENCY["streaming"].percentile(
+        CLEARBIT_LATENCY_PERCENTILE)
+    if expected is None:
+        expected = CLEARBIT_STREAMING_LATENCY_PRIOR
+    return "streaming" if expected <= latency_budget else "polling"
+
+
+def get_clearbit_latency_stats():
+    """Utility function that returns the latency stats of each
+    mode."""
+    return MetadataMixin(
+        (mode, histogram.get_stats())
+        for mode, histogram in CLEARBIT_LATENCY.items()
+    )
+
+
+def send_clearbit_request(request=None, endpoint=None, streaming=False,
+                          deadline=None):
+    """Utility function that sends a single lookup to a Clearbit
+    endpoint and returns the response. The read timeout is cut short to
+    end by the `deadline` (epoch seconds), if one is given."""
+    url, streaming_url, api_version = CLEARBIT_APIS[endpoint]
+    if endpoint == "reveal":
+        params = {"ip": request["ip_address"]}
+    else:
+        params = {
+            "email": request["email"],
+            "domain": request["domain"]
+        }
+    connect_timeout, read_timeout = HTTP_TIMEOUT
+    if streaming is True and streaming_url is not None:
+        url = streaming_url
+        connect_timeout, read_timeout = CLEARBIT_STREAMING_TIMEOUT
+    if deadline is not None:
+        read_timeout = max(min(read_timeout, deadline - time.time()), 1.0)
+    timeout = (connect_timeout, read_timeout)
+    return get_session("clearbit").get(
+        url=url,
+        params=params,
+        auth=(clearbit.key, ""),
+        headers={
+            "API-Version": api_version
+        },
+        timeout=timeout
+    )
+
+
+def get_clearbit_cache_key(request=None, endpoint=None):
+    """Utility function that returns the response cache key for a
+    lookup, built from the parameters actually sent to the endpoint."""
+    api_version = CLEARBIT_APIS[endpoint][2]
+    if endpoint == "reveal":
+        return ClearbitCache.get_key(endpoint=endpoint,
+                                     api_version=api_version,
+                                     ip_address=request["ip_address"])
+    return ClearbitCache.get_key(endpoint=endpoint,
+                                 api_version=api_version,
+                                 email=request["email"],
+                                 domain=request["domain"])
+
+
+def make_clearbit_error(status=None, headers=None):
+    """Utility function that returns the payload for a failed
+    lookup."""
+    status = "5xx" if status[0] == "5" else status
+    resp = {
+        "error": CLEARBIT_ERRORS.get(status, status),
+        "status": status,
+        "company": None,
+        "person": None
+    }
+    if status == "402" and headers is not None:
+        resp["quota_info"] = dict(headers)
+    return resp
+
+
+def get_clearbit_budget_error(resp=None):
+    """Utility function that returns what `clearbit_routines` returns
+    once its latency budget runs out: the pending response, if the
+    lookup was pending, or a "timeout" error. Neither is cached."""
+    if resp is not None and resp.status_code == 202:
+        return resp
+    return make_clearbit_error(status="timeout")
+
+
+def _clearbit_attempt(request=None, streaming=False, rate_limiter=None,
+                      cache=None):
+    """Sends one lookup for `enrich_many`. Returns "done", "pending" or
+    "retry", the payload to return if no more attempts are made and the
+    mode it was sent in. Matches and "not found" results are added to
+    the `cache`."""
+    endpoint = get_clearbit_endpoint(request=request)
+    if endpoint is None:
+        return "done", make_clearbit_error(status="422"), None
+    mode = choose_clearbit_mode(endpoint=endpoint, streaming=streaming)
+    rate_limiter.acquire()
+    try:
+        resp = send_clearbit_request(request=request,
+                                     endpoint=endpoint,
+                                     streaming=mode == "streaming")
+        rate_limiter.update(headers=resp.headers)
+        status = resp.status_code
+        # 202 (async lookup; try again momentarily)
+        if status == 201 or status == 202 or \
+                (status == 200 and "pending" in resp.json()):
+            result = resp.json()
+            # flagged as an error if it's still pending at the end
+            result["error"] = True
+            return "pending", result, mode
+        if status == 200:
+            result = resp.json()
+        else:
+            result = make_clearbit_error(status=str(status),
+                                         headers=resp.headers)
+        if cache is not None and (status == 200 or status == 404):
+            cache.set(key=get_clearbit_cache_key(request=request,
+                                                 endpoint=endpoint),
+                      resp=result,
+                      status_code=status)
+        if status == 200:
+            return "done", result, mode
+        if status == 429 or status >= 500:
+            return "retry", result, mode
+        # other client errors won't change on a retry
+        return "done", result, mode
+    # catch-all; reported as an "error" rather than not found, so it's
+    # retried and never cached
+    except Exception as e:
+        print("Error: {}".format(e))
+        return "retry", make_clearbit_error(status="error"), mode
+
+
+def enrich_many(batch=None, streaming=False,
+                max_workers=CLEARBIT_MAX_WORKERS,
+                poll_interval=SLEEP_LENGTH, max_retries=MAX_RETRIES,
+                rate_limiter=None, cache=CLEARBIT_CACHE):
+    """Utility function that runs the Clearbit lookups for a batch of
+    requests concurrently and yields `(index, response)` as each one
+    finishes, with the same responses as `clearbit_routines`.
+
+    Pending (202) lookups are parked and polled again `poll_interval`
+    seconds later while the rest proceed; throttled and failed lookups
+    are retried right away. Each request gets at most `max_retries`
+    attempts, and all of them share `rate_limiter`. Lookups found in
+    the `cache` are answered without a request.
+
+    `streaming` is True, False or "auto" (see `choose_clearbit_mode`);
+    the latency of each lookup is recorded under the mode of its first
+    attempt, or as polling if it was ever pending."""
+    print("enrich_many()")
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter()
+    attempts = [0] * len(batch)
+    # index -> (time, mode) of the first attempt
+    started = dict()
+    # (poll_at, index) of the pending lookups
+    parked = list()
+    running = dict()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit(i):
+            attempts[i] += 1
+            if i not in started:
+                started[i] = (time.time(), None)
+            future = executor.submit(_clearbit_attempt,
+                                     request=batch[i],
+                                     streaming=streaming,
+                                     rate_limiter=rate_limiter,
+                                     cache=cache)
+            running[future] = i
+
+        cached = list()
+        for i, request in enumerate(batch):
+            endpoint = get_clearbit_endpoint(request=request)
+            resp = None
+            if cache is not None and endpoint is not None:
+                resp = cache.get(
+                    key=get_clearbit_cache_key(request=request,
+                                               endpoint=endpoint),
+                    endpoint=endpoint
+                )
+            if resp is None:
+                submit(i)
+            else:
+                cached.append((i, resp))
+        for i, resp in cached:
+            yield i, resp
+        while len(running) != 0 or len(parked) != 0:
+            now = time.time()
+            while len(parked) != 0 and parked[0][0] <= now:
+                submit(heapq.heappop(parked)[1])
+            timeout = None
+            if len(parked) != 0:
+                timeout = max(parked[0][0] - now, 0.0)
+            if len(running) == 0:
+                time.sleep(timeout)
+                continue
+            done, _ = wait(list(running), timeout=timeout,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                state, resp, mode = future.result()
+                start, first_mode = started[i]
+                if first_mode is None:
+                    first_mode = mode
+                    started[i] = (start, mode)
+                if state == "done" or attempts[i] >= max_retries:
+                    if first_mode is not None:
+                        CLEARBIT_LATENCY[first_mode].record(
+                            time.time() - start)
+                    yield i, resp
+                elif state == "pending":
+                    print("request is pending.")
+                    # recorded as polling once it's had to be polled
+                    started[i] = (start, "polling")
+                    heapq.heappush(parked, (time.time() + poll_interval,
+                                            i))
+                else:
+                    submit(i)
+
+
+def clearbit_routines(request=None, streaming=False, rate_limiter=None,
+                      cache=CLEARBIT_CACHE, latency_budget=None):
+    """Enrichment routines that wrap the Clearbit API.
+
+    `streaming` is True, False or "auto": streaming lookups are held
+    open by Clearbit until they're done, polling lookups are retried
+    every `SLEEP_LENGTH` seconds while they're pending and give up once
+    the next poll would overrun `latency_budget` seconds; no attempt,
+    including a retry after an error, starts once the budget is spent.
+    "auto" picks the mode per call (see `choose_clearbit_mode`), and
+    each call's latency is recorded in `CLEARBIT_LATENCY` under the
+    mode it finished in.
+
+    Requests are paced by `rate_limiter` (the process-wide limiter from
+    `get_rate_limiter` by default), which is updated from the rate
+    limit headers of every response. Matches and "not found" results
+    are kept in the `cache` and answered from it while they're fresh;
+    pass `cache=None` to always send the request."""
     print("clearbit_routines()")
+    if rate_limiter is None:
+        rate_limiter = get_rate_limiter()
+    endpoint = get_clearbit_endpoint(request=request)
+    cache_key = None
+    if cache is not None and endpoint is not None:
+        cache_key = get_clearbit_cache_key(request=request,
+                                           endpoint=endpoint)
+        cached = cache.get(key=cache_key, endpoint=endpoint)
+        if cached is not None:
+            print("returning cached response.")
+            return cached
+    start = time.time()
+    deadline = None if latency_budget is None else start + latency_budget
+    mode = None
+    if endpoint is not None:
+        mode = choose_clearbit_mode(endpoint=endpoint,
+                                    streaming=streaming,
+                                    latency_budget=latency_budget)
+        print("mode: {}".format(mode))
+    # the mode can fall back to polling partway through
+    send_mode = mode
     # TODO: add functionality to enable revealing and then enriching
     #  make the appropriate endpoint request
     # TODO: make sure to return the expected payload here
     CONTINUE = True
     n = 0
+    resp = None
 
     while CONTINUE and n < MAX_RETRIES:
+        # checked before every attempt, including the retries after a
+        # request raised, so a spent budget isn't retried
+        if deadline is not None and time.time() >= deadline:
+            print("latency budget exhausted.")
+            # a pending lookup is returned flagged as an error below
+            resp = get_clearbit_budget_error(resp=resp)
+            break
+        # counted up front so requests that raise (timeouts, connection
+        # errors) still use up an attempt
+        n += 1
         try:
             if request["clearbit_reveal"] is True:
                 print("Reveal API")
                 # ip_address = request["ip_address"]
                 print("ip_address: {}".format(request["ip_address"]))
 
-                # TODO: find out if there is a streaming endpoint for
-                #  Reveal
-                if streaming is True:
-                    resp = requests.get(
-                        url=
-                        "https://reveal.clearbit.com/v1/companies/find",
-                        params={"ip": request["ip_address"]},
-                        auth=(clearbit.key, ""),
-                        headers={
-                            "API-Version": "2018-03-28"
-                        }
-                    )
-                else:
-                    resp = requests.get(
-                        url=
-                        "https://reveal.clearbit.com/v1/companies/find",
-                        params={"ip": request["ip_address"]},
-                        auth=(clearbit.key, ""),
-                        headers={
-                            "API-Version": "2018-03-28"
-                        }
-                    )
-                n += 1
+                # the wait for a request slot is bounded by the budget too
+                if rate_limiter.acquire(
+                        timeout=None if deadline is None
+                        else deadline - time.time()) is None:
+                    print("latency budget exhausted.")
+                    resp = get_clearbit_budget_error(resp=resp)
+                    break
+                resp = send_clearbit_request(request=request,
+                                             endpoint="reveal",
+                                             deadline=deadline)
 
                 # DEPRECATED
                 # resp = clearbit.Reveal.find(ip=ip_address,
                 #                             streaming=streaming)
 
 
-                # TODO: figure out how to implement this
-                # rate limit check (we'll pause with this request to
-                # control the flow of future requests
+                # rate limit check; the limiter paces the following
+                # requests and holds them until the reset when the
+                # budget is used up
+                rate_limiter.update(headers=resp.headers)
                 results = check_clearbit_rate_limit(
                     response=resp
                 )
-                if results["rate_limit_exceeded"] is True:
-                    reset_time = int(results["reset_time"])
-                    current_time = time.time()
-                    sleep_time = reset_time - current_time
-                    if sleep_time > 0:
-                        time.sleep(sleep_time + 1)
-                        continue
-                    else:
-                        pass
-                else:
+                if results["rate_limit_exceeded"] is True and \
+                        resp.status_code == 429:
+                    continue
+                elif results["rate_limit_exceeded"] is False:
                     print("still within rate limit.")
 
                 print("request sent")
@@ -607,6 +971,10 @@ def clearbit_routines(request=None, streaming=False):
                 # 202 (async lookup; try again momentarily)
                 if "pending" in resp.json().keys():
                     print("request is pending.")
+                    if deadline is not None and \
+                            time.time() + SLEEP_LENGTH > deadline:
+                        print("latency budget exhausted.")
+                        break
                     time.sleep(SLEEP_LENGTH)
                     continue
 
@@ -637,77 +1005,36 @@ def clearbit_routines(request=None, streaming=False):
                 #  of cxmybiz.com)
                 print("Enrichment API")
                 print("email_address: {}".format(request["email"]))
-                params = {
-                    "email": request["email"],
-                    "domain": request["domain"]
-                }
 
                 # determine from the payload which endpoint to hit
-                enrichment_api = "person" if request["email"] is not \
-                                             None else "company"
+                enrichment_api = get_clearbit_endpoint(request=request)
                 print("enrichment api: {}".format(enrichment_api))
                 print("sending request")
-                # TODO: implement manual streaming
-                if streaming is True:
-                    if enrichment_api == "person":
-                        resp = requests.get(
-                            url="https://person-stream.clearbit.com/v2"
-                                "/combined/find",
-                            params={**params},
-                            auth=(clearbit.key, ""),
-                            headers={
-                                "API-Version": "2018-11-19"
-                            }
-                        )
-
-                    elif enrichment_api == "company":
-                        resp = requests.get(
-                            url="https://company-stream.clearbit.com/v2"
-                                "/companies/find",
-                            params={**params},
-                            auth=(clearbit.key, ""),
-                            headers={
-                                "API-Version": "2017-09-12"
-                            }
-                        )
-                else:
-                    if enrichment_api == "person":
-                        resp = requests.get(
-                            url="https://person.clearbit.com/v2/combined/find",
-                            params={**params},
-                            auth=(clearbit.key, ""),
-                            headers={
-                                "API-Version": "2018-11-19"
-                            }
-                        )
-                    elif enrichment_api == "company":
-                        resp = requests.get(
-                            url="https://company.clearbit.com/v2/companies/find",
-                            params={**params},
-                            auth=(clearbit.key, ""),
-                            headers={
-                                "API-Version": "2017-09-12"
-                            }
-                        )
-                n += 1
-
-                # TODO: figure out how to do this
-                # rate limit check (we'll pause with this request to
-                # control the flow of future requests
+                # the wait for a request slot is bounded by the budget too
+                if rate_limiter.acquire(
+                        timeout=None if deadline is None
+                        else deadline - time.time()) is None:
+                    print("latency budget exhausted.")
+                    resp = get_clearbit_budget_error(resp=resp)
+                    break
+                resp = send_clearbit_request(
+                    request=request,
+                    endpoint=enrichment_api,
+                    streaming=send_mode == "streaming",
+                    deadline=deadline
+                )
+
+                # rate limit check; the limiter paces the following
+                # requests and holds them until the reset when the
+                # budget is used up
+                rate_limiter.update(headers=resp.headers)
                 results = check_clearbit_rate_limit(
                     response=resp
                 )
-
-                if results["rate_limit_exceeded"] is True:
-                    reset_time = int(results["reset_time"])
-                    current_time = time.time()
-                    sleep_time = reset_time - current_time
-                    if sleep_time > 0:
-                        time.sleep(sleep_time + 1)
-                        continue
-                    else:
-                        pass
-                else:
+                if results["rate_limit_exceeded"] is True and \
+                        resp.status_code == 429:
+                    continue
+                elif results["rate_limit_exceeded"] is False:
                     print("still within rate limit.")
 
                 print("request sent")
@@ -716,6 +1043,12 @@ def clearbit_routines(request=None, streaming=False):
                 # 202 (async lookup; try again momentarily)
                 if resp.status_code == 201 or resp.status_code == 202:
                     print("request is pending.")
+                    # the streaming endpoint gave up on the lookup
+                    send_mode = "polling"
+                    if deadline is not None and \
+                            time.time() + SLEEP_LENGTH > deadline:
+                        print("latency budget exhausted.")
+                        break
                     time.sleep(SLEEP_LENGTH)
                     continue
                 # if "pending" in resp.keys():
@@ -796,18 +1129,19 @@ def clearbit_routines(request=None, streaming=False):
                     break
                 continue
             if status == "404":
-                if n == MAX_RETRIES - 1:
-                    # we still need to return the expected payload
-                    resp = {
-                        "error": "Person/Company Not Found",
-                        "status": "404",
-                        "company": None,
-                        "person": None
-                    }
-                    print(resp)
-                    print("404 error.")
-                    break
-                continue
+                # not found won't change on a retry, so stop and cache
+                # it (as `enrich_many` does)
+                resp = {
+                    "error": "Person/Company Not Found",
+                    "status": "404",
+                    "company": None,
+                    "person": None
+                }
+                print(resp)
+                print("404 error.")
+                if cache_key is not None:
+                    cache.set(key=cache_key, resp=resp, status_code=404)
+                break
 
             if status == "422":
                 if n == MAX_RETRIES - 1:
@@ -897,12 +1231,23 @@ def clearbit_routines(request=None, streaming=False):
         if resp.status_code == 200:
             print("request succeeded")
             resp = resp.json()
+            if cache_key is not None:
+                cache.set(key=cache_key, resp=resp, status_code=200)
         if resp.status_code == 202:
             print("request was pending for too long.")
             resp = resp.json()
             # we'll flag this as an error
             resp["error"] = True
+        elif resp.status_code == 429:
+            # throttled on every attempt; we still need to return the
+            # expected payload
+            resp = make_clearbit_error(status="429")
+            print(resp)
+            print("429 error.")
     except AttributeError as e:
         pass
+    # a streaming lookup that fell back to polling counts as polling
+    if send_mode is not None:
+        CLEARBIT_LATENCY[send_mode].record(time.time() - start)
     print("returning response.")
     return resp
@@ -0,0 +1,63 @@
+"""
+compression.py: Byte compression helpers shared by the services.
+
+zstd is used when the optional `zstandard` package is installed and
+gzip otherwise. Compressed data can be decompressed without knowing the
+method since both formats start with a magic number.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+DEFAULT_COMPRESSION = "gzip" if zstandard is None else "zstd"
+
+
+def compress(data=None, method=None, level=None):
+    """Compresses the bytes with "zstd", "gzip" or "none"."""
+    method = DEFAULT_COMPRESSION if method is None else method
+    if method == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression requires `zstandard`")
+        level = 3 if level is None else level
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if method == "gzip":
+        level = 6 if level is None else level
+        return gzip.compress(data, compresslevel=level)
+    if method == "none":
+        return data
+    raise ValueError("unknown compression method: {}".format(method))
+
+
+def detect_compression(data=None):
+    """Returns the compression method of the bytes from their magic
+    number."""
+    if data[:2] == GZIP_MAGIC:
+        return "gzip"
+    if data[:4] == ZSTD_MAGIC:
+        return "zstd"
+    return "none"
+
+
+def decompress(data=None, method=None):
+    """Decompresses the bytes, detecting the method when it isn't
+    supplied."""
+    method = detect_compression(data) if method is None else method
+    if method == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd decompression requires `zstandard`")
+        # the frame may not record its content size when streamed
+        return zstandard.ZstdDecompressor().decompressobj() \
+            .decompress(data)
+    if method == "gzip":
+        return gzip.decompress(data)
+    if method == "none":
+        return data
+    raise ValueError("unknown compression method: {}".format(method))
@@ -3,7 +3,134 @@ constants.py : contains constant values used by the various functions.
 """
 __author__ = "Jason Wolosonovich <jason@avaland.io>"
 __license__ = "BSD 3 Clause"
+import os
 
 
 MAX_RETRIES = 3
 SLEEP_LENGTH = 15.0
+
+# bigquery streaming inserts
+BQ_MAX_RETRIES = 7
+BQ_MAX_ROWS_PER_BATCH = 500
+# the streaming api rejects requests over 10MB so leave some headroom
+BQ_MAX_BYTES_PER_BATCH = 5000000
+
+# outbound http
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_READ_TIMEOUT = 30.0
+HTTP_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+# number of per-host pools kept per session and connections per pool
+HTTP_POOL_CONNECTIONS = 32
+HTTP_POOL_MAXSIZE = 16
+# the mobile friendly test renders the page server-side
+MOBILE_FRIENDLY_TIMEOUT = (HTTP_CONNECT_TIMEOUT, 120.0)
+# the streaming endpoints hold the request open until the lookup is done
+# (up to a minute), so read for a while longer than that
+CLEARBIT_STREAMING_TIMEOUT = (HTTP_CONNECT_TIMEOUT, 90.0)
+# the streaming latency compared to a call's budget in "auto" mode
+CLEARBIT_LATENCY_PERCENTILE = 90
+# streaming latency assumed until streaming lookups have been timed; most
+# lookups finish within a few seconds
+CLEARBIT_STREAMING_LATENCY_PRIOR = 10.0
+
+# url resolution
+URL_CACHE_TTL = 3600
+# domains that couldn't be resolved are probed again after a minute
+URL_FAILURE_CACHE_TTL = 60
+URL_CACHE_MAXSIZE = 10000
+URL_PROBE_WORKERS = 16
+
+# crawler
+CRAWL_MAX_CONCURRENCY = 50
+CRAWL_MAX_PER_HOST = 2
+# seconds allowed for a single page fetch, including redirects
+CRAWL_TIMEOUT = 45.0
+# pages are truncated past this many bytes
+CRAWL_MAX_BYTES = int(os.environ.get("RFTK_CRAWL_MAX_BYTES", 5000000))
+CRAWL_MAX_REDIRECTS = 5
+CRAWL_CHUNK_SIZE = 65536
+# how far into a page to look for its <meta> charset
+HTML_CHARSET_SNIFF_BYTES = 4096
+# "html.parser", "lxml" or "selectolax"
+HTML_PARSER = os.environ.get("RFTK_HTML_PARSER", "html.parser")
+# bucket the compressed crawled html is stored in
+HTML_BUCKET = os.environ.get("RFTK_HTML_BUCKET")
+
+# page cache
+PAGE_CACHE_TTL = 7 * 24 * 3600
+PAGE_CACHE_MAXSIZE = 10000
+
+# content classification
+# the API bills per 1000 characters and the first few thousand words
+# are plenty to classify a page
+CLASSIFY_MAX_CHARS = 10000
+CLASSIFY_WORKERS = 8
+CLASSIFY_CACHE_MAXSIZE = 10000
+CLASSIFY_CACHE_DIR = os.environ.get("RFTK_CLASSIFY_CACHE_DIR")
+
+# content classifier: "cloud", "local" or "cloud+local"
+CLASSIFIER = os.environ.get("RFTK_CLASSIFIER", "cloud")
+# `.npz` model saved by `HashingClassifier.save`
+CLASSIFIER_MODEL_PATH = os.environ.get("RFTK_CLASSIFIER_MODEL")
+CLASSIFIER_N_FEATURES = 2 ** 16
+CLASSIFIER_MIN_SCORE = 0.1
+CLASSIFIER_TOP_K = 3
+# bounds the scratch matrix used when scoring a batch
+CLASSIFIER_MAX_CELLS = 2 ** 24
+
+# bulk email validation and id generation
+BULK_CHUNK_SIZE = 100000
+BULK_MEMO_MAXSIZE = 1000000
+REFINERY_ID_MEMO_MAXSIZE = 100000
+
+# pubsub
+PUBSUB_PROJECT = "infusionsoft-looker-poc"
+# seconds `publish_to_endpoint` waits for outstanding publishes
+PUBLISH_TIMEOUT = 60.0
+
+# pubsub message envelope
+# "json" or "msgpack"
+MESSAGE_CODEC = os.environ.get("RFTK_MESSAGE_CODEC", "json")
+# "none", "gzip" or "zstd"
+MESSAGE_COMPRESSION = os.environ.get("RFTK_MESSAGE_COMPRESSION", "none")
+# smaller bodies aren't worth compressing
+MESSAGE_COMPRESS_MIN_BYTES = 1024
+
+# claim-check: messages encoded larger than this are written to GCS and
+# a pointer is published instead
+CLAIM_CHECK_BYTES = int(os.environ.get("RFTK_CLAIM_CHECK_BYTES", 1000000))
+CLAIM_CHECK_BUCKET = os.environ.get("RFTK_CLAIM_CHECK_BUCKET")
+CLAIM_CHECK_PREFIX = "claim-checks/"
+
+# batch gcs transfers
+GCS_MAX_WORKERS = 16
+# seconds before the first retry; doubled after each attempt
+GCS_RETRY_BACKOFF = 0.5
+
+# clearbit rate limiting
+# requests per second until the rate limit headers have been seen
+# (clearbit allows 600 a minute)
+CLEARBIT_RATE_LIMIT = 10.0
+# share the limiter between processes through this file
+CLEARBIT_RATE_LIMIT_FILE = os.environ.get("RFTK_CLEARBIT_RATE_LIMIT_FILE")
+# seconds to wait past the reset once the budget is used up
+RATE_LIMIT_RESET_MARGIN = 1.0
+# concurrent lookups in `enrich_many`
+CLEARBIT_MAX_WORKERS = 8
+
+# clearbit response cache
+# "memory", "disk" (RFTK_CLEARBIT_CACHE_PATH is a directory) or "sqlite"
+# (RFTK_CLEARBIT_CACHE_PATH is the database file)
+CLEARBIT_CACHE_BACKEND = os.environ.get("RFTK_CLEARBIT_CACHE_BACKEND",
+                                        "memory")
+CLEARBIT_CACHE_PATH = os.environ.get("RFTK_CLEARBIT_CACHE_PATH")
+CLEARBIT_CACHE_MAXSIZE = 10000
+# matches
+CLEARBIT_CACHE_TTL = 7 * 24 * 3600
+# "Person/Company Not Found"
+CLEARBIT_CACHE_NOT_FOUND_TTL = 24 * 3600
+
+# decrypted secrets are cached for this many seconds before they're read
+# from gcs and decrypted again
+SECRETS_TTL = int(os.environ.get("RFTK_SECRETS_TTL", 3600))
+SECRETS_CACHE_MAXSIZE = 16
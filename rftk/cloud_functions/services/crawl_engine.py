@@ -0,0 +1,169 @@
+"""
+crawl_engine.py: Asyncio engine for crawling batches of domains.
+
+Fetches are bounded by a global and a per-host concurrency limit and
+each page is handed to the crawler routines as soon as its download
+completes.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
+
+from .constants import HTTP_TIMEOUT, CRAWL_MAX_CONCURRENCY, \
+    CRAWL_MAX_PER_HOST, CRAWL_TIMEOUT, CRAWL_MAX_BYTES, \
+    CRAWL_MAX_REDIRECTS
+from .crawler_service import crawl_and_parse, domain_routines, \
+    squarespace_routines, wordpress_routines, site_routines
+from .functions import get_valid_url
+
+
+def run_wordpress_routines(request=None, document=None):
+    """Adapts `wordpress_routines` to the (request, document) signature
+    used by the engine."""
+    request = request.copy()
+    request["document"] = document
+    return wordpress_routines(request=request,
+                              has_html=True,
+                              is_parsed=True)
+
+
+ROUTINES = {
+    "domain": domain_routines,
+    "squarespace": squarespace_routines,
+    "wordpress": run_wordpress_routines,
+    "site": site_routines,
+}
+
+
+async def crawl_one(request=None, routine=None, loop=None,
+                    executor=None, global_limit=None, host_limits=None,
+                    max_per_host=CRAWL_MAX_PER_HOST,
+                    timeout=CRAWL_TIMEOUT, max_bytes=CRAWL_MAX_BYTES,
+                    max_redirects=CRAWL_MAX_REDIRECTS):
+    """Fetches a single request under the concurrency limits and runs
+    the routine over the parsed page. Returns a (request, result,
+    error) tuple.
+
+    The fetch is bounded by `timeout` seconds inside `fetch_html`
+    rather than by cancelling the await, so a slot is only given back
+    once its thread has actually stopped downloading."""
+    start = time.time()
+    try:
+        async with global_limit:
+            url = request.get("url")
+            if url is None:
+                url = await loop.run_in_executor(
+                    executor,
+                    partial(get_valid_url, domain=request["domain"])
+                )
+                if url is None:
+                    return request, None, "error: no valid url"
+                request = request.copy()
+                request["url"] = url
+
+            host = urlparse(url).hostname
+            if host not in host_limits:
+                host_limits[host] = asyncio.Semaphore(max_per_host)
+
+            async with host_limits[host]:
+                document = await loop.run_in_executor(
+                    executor,
+                    partial(crawl_and_parse,
+                            url=url,
+                            timeout=HTTP_TIMEOUT,
+                            max_bytes=max_bytes,
+                            max_redirects=max_redirects,
+                            deadline=time.time() + timeout)
+                )
+
+        if isinstance(document, str):
+            return request, None, document
+
+        # the routines are run outside of the fetch limits so a slow
+        # classification call doesn't hold up the downloads
+        result = await loop.run_in_executor(
+            executor,
+            partial(routine, request=request, document=document)
+        )
+        return request, result, None
+    except Exception as e:
+        return request, None, "error: {}".format(e)
+    finally:
+        print("crawled {} in {:.2f}s".format(request.get("url"),
+                                             time.time() - start))
+
+
+async def crawl_batch_async(requests=None, routine="domain",
+                            max_concurrency=CRAWL_MAX_CONCURRENCY,
+                            max_per_host=CRAWL_MAX_PER_HOST,
+                            timeout=CRAWL_TIMEOUT,
+                            max_bytes=CRAWL_MAX_BYTES,
+                            max_redirects=CRAWL_MAX_REDIRECTS):
+    """Crawls a batch of requests concurrently, yielding a (request,
+    result, error) tuple for each request as soon as it finishes.
+
+    `routine` is either one of the names in `ROUTINES` or a callable
+    taking `request` and `document` keyword arguments."""
+    print("crawl_batch_async()")
+    if isinstance(routine, str):
+        routine = ROUTINES[routine]
+    loop = asyncio.get_event_loop()
+    global_limit = asyncio.Semaphore(max_concurrency)
+    host_limits = dict()
+    # fetches and routines share the pool so it must cover both
+    executor = ThreadPoolExecutor(max_workers=2 * max_concurrency)
+    try:
+        tasks = [
+            crawl_one(request=request,
+                      routine=routine,
+                      loop=loop,
+                      executor=executor,
+                      global_limit=global_limit,
+                      host_limits=host_limits,
+                      max_per_host=max_per_host,
+                      timeout=timeout,
+                      max_bytes=max_bytes,
+                      max_redirects=max_redirects)
+            for request in requests
+        ]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        executor.shutdown(wait=False)
+
+
+def crawl_batch(requests=None, routine="domain", callback=None,
+                **kwargs):
+    """Synchronous entry point for `crawl_batch_async`.
+
+    `callback(request, result, error)` is called for each request as it
+    completes; the list of (request, result, error) tuples is returned
+    once the whole batch is done."""
+    print("crawl_batch()")
+    start = time.time()
+    results = list()
+
+    async def consume():
+        async for request, result, error in crawl_batch_async(
+                requests=requests, routine=routine, **kwargs):
+            if callback is not None:
+                callback(request, result, error)
+            results.append((request, result, error))
+
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(consume())
+    finally:
+        loop.close()
+        asyncio.set_event_loop(None)
+
+    n_errors = len([r for r in results if r[2] is not None])
+    print("pages crawled: {}".format(len(results)))
+    print("errors: {}".format(n_errors))
+    print("time elapsed (seconds): {0:.1f}".format(time.time() - start))
+    return results
@@ -3,16 +3,51 @@ crawler_service.py: Utility functions used by the crawler service.
 """
 __author__ = "Jason Wolosonovich <jason@avaland.io>"
 __license__ = "BSD 3 clause"
-from urllib.parse import urlparse
-import re
+from urllib.parse import urlparse, urljoin
 import json
+import time
+import hashlib
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 import google.cloud.language as language
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag, NavigableString, CData
+from bs4 import FeatureNotFound
 
-from .classes import MetadataMixin
+# optional fast parser backend
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser as SelectolaxParser
+    except ImportError:
+        SelectolaxParser = None
 
+from .caches import ClassificationCache
+from .classes import MetadataMixin
+from .compression import compress
+from .patterns import EMAIL_TEXT_RE, PHONE_RE, WP_PLUGIN_RE, \
+    WP_THEME_RE, SQUARESPACE_CONTEXT_RE, EXTERNAL_LINK_RE, CHARSET_RE, \
+    META_CHARSET_RE
+from .constants import HTTP_TIMEOUT, CRAWL_MAX_REDIRECTS, \
+    CRAWL_CHUNK_SIZE, CRAWL_MAX_BYTES, HTML_PARSER, HTML_BUCKET, \
+    CLASSIFY_MAX_CHARS, CLASSIFY_WORKERS, HTML_CHARSET_SNIFF_BYTES
+from .sessions import get_session
+
+
+# the string types bs4 includes in `Tag.text`
+TEXT_TYPES = (NavigableString, CData)
+# the only tags the extractors look at
+INDEXED_TAGS = ("a", "link", "meta", "script")
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+# the `domain_routines` results kept in the page cache
+PAGE_CACHE_FIELDS = ("all_links", "internal_links", "external_links",
+                     "href_emails", "href_phones", "href_socials",
+                     "meta_keywords", "meta_description",
+                     "content_classification", "html_sha256",
+                     "html_bytes")
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -20,6 +55,234 @@ HEADERS = {
                   "Chrome/61.0.3163.100 Safari/537.36"
 }
 
+# one client (and gRPC channel) for the life of the process
+_LANGUAGE_CLIENT = None
+_LANGUAGE_CLIENT_LOCK = threading.Lock()
+CLASSIFICATION_CACHE = ClassificationCache()
+_CLASSIFY_EXECUTOR = ThreadPoolExecutor(max_workers=CLASSIFY_WORKERS)
+
+
+class DocumentIndex(object):
+    """Everything the extractors need from a parsed page, collected in a
+    single walk of the tree: anchor hrefs, `link` hrefs, `meta` contents
+    by name, named scripts and a cached text projection.
+
+    Works over BeautifulSoup trees (html.parser or lxml) and selectolax
+    trees, so the extractors don't depend on the parser backend."""
+    def __init__(self, document=None):
+        self.document = document
+        self.anchors = list()
+        self.link_hrefs = list()
+        self.metas = dict()
+        self.named_scripts = dict()
+        self._strings = list()
+        self._text = None
+        # the raw bytes the page was parsed from, when known, and the
+        # charset from its response headers
+        self.source = None
+        self.encoding = None
+
+        if isinstance(document, Tag):
+            self.parser = "bs4"
+            self._index_soup(document)
+        else:
+            self.parser = "selectolax"
+            self._index_selectolax(document)
+
+    def _add_tag(self, tag_name=None, attrs=None, node=None):
+        if tag_name == "a":
+            href = attrs.get("href")
+            if href is not None:
+                self.anchors.append(href)
+        elif tag_name == "link":
+            href = attrs.get("href")
+            if href is not None:
+                self.link_hrefs.append(href)
+        elif tag_name == "meta":
+            name = attrs.get("name")
+            content = attrs.get("content")
+            if name is not None and content is not None:
+                self.metas.setdefault(name, list()).append(content)
+        elif tag_name == "script":
+            name = attrs.get("data-name")
+            if name is not None and name not in self.named_scripts:
+                self.named_scripts[name] = node
+
+    def _index_soup(self, document=None):
+        add_tag = self._add_tag
+        for node in document.descendants:
+            node_type = type(node)
+            if node_type is not Tag:
+                # matches what `document.text` would include
+                if node_type in TEXT_TYPES:
+                    self._strings.append(node)
+                continue
+            if node.name in INDEXED_TAGS:
+                add_tag(tag_name=node.name, attrs=node.attrs, node=node)
+
+    def _index_selectolax(self, document=None):
+        add_tag = self._add_tag
+        for node in document.css(", ".join(INDEXED_TAGS)):
+            add_tag(tag_name=node.tag, attrs=node.attributes, node=node)
+
+    @property
+    def text(self):
+        if self._text is None:
+            if self.parser == "bs4":
+                self._text = "".join(self._strings)
+            elif self.document.root is not None:
+                self._text = self.document.root.text(deep=True)
+            else:
+                self._text = ""
+        return self._text
+
+    def get_script_text(self, name=None):
+        """Returns the stripped text of the first script with the
+        supplied `data-name`."""
+        node = self.named_scripts[name]
+        if self.parser == "bs4":
+            return node.getText(strip=True)
+        return node.text(deep=True, strip=True)
+
+    def to_html(self):
+        """Returns the page serialized back to html."""
+        if self.parser == "bs4":
+            return self.document.prettify()
+        return self.document.html
+
+
+def get_charset(content_type=None):
+    """Utility function that returns the charset of a Content-Type
+    header, or None."""
+    if content_type is None:
+        return None
+    match = CHARSET_RE.search(content_type)
+    return None if match is None else match.group(1)
+
+
+def decode_html(content=None, encoding=None):
+    """Utility function that decodes the html bytes with the charset
+    from the response headers (`encoding`), else the page's `<meta>`
+    charset, else utf-8, falling back to windows-1252 (what browsers
+    assume for unlabelled pages)."""
+    if isinstance(content, str):
+        return content
+    candidates = [encoding]
+    match = META_CHARSET_RE.search(content[:HTML_CHARSET_SNIFF_BYTES])
+    if match is not None:
+        candidates.append(match.group(1).decode("ascii", errors="ignore"))
+    candidates.append("utf-8")
+    for candidate in candidates:
+        if candidate is None:
+            continue
+        try:
+            return content.decode(candidate)
+        except (LookupError, UnicodeDecodeError):
+            continue
+    return content.decode("windows-1252", errors="replace")
+
+
+def parse_html(content=None, parser=None, encoding=None):
+    """Utility function that parses the html with the configured parser
+    backend ("html.parser", "lxml" or "selectolax"). Bytes are decoded
+    with `decode_html`; pass the charset of the response headers as
+    `encoding`.
+
+    The BeautifulSoup backends return the soup; selectolax returns a
+    `DocumentIndex` over its tree. Either one can be handed to the
+    extractors."""
+    parser = HTML_PARSER if parser is None else parser
+    source = content
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+        encoding = "utf-8"
+    content = decode_html(content=content, encoding=encoding)
+    if parser == "selectolax":
+        if SelectolaxParser is not None:
+            document = DocumentIndex(document=SelectolaxParser(content))
+            document.source = source
+            document.encoding = encoding
+            return document
+        print("selectolax is not installed; using html.parser")
+        parser = "html.parser"
+    try:
+        document = BeautifulSoup(content, parser)
+    except FeatureNotFound as e:
+        print("{}; using html.parser".format(e))
+        document = BeautifulSoup(content, "html.parser")
+    # keep the original bytes around so they can be stored as-is
+    document._rftk_source = source
+    document._rftk_encoding = encoding
+    return document
+
+
+def get_document_index(document=None):
+    """Returns the `DocumentIndex` for the document, building it the
+    first time it's requested."""
+    if isinstance(document, DocumentIndex):
+        return document
+    if not isinstance(document, Tag):
+        # selectolax trees can't carry the cached index
+        return DocumentIndex(document=document)
+    # bs4 turns unknown attribute lookups into tree searches so go
+    # through __dict__ rather than getattr
+    index = vars(document).get("_rftk_index")
+    if index is None:
+        index = DocumentIndex(document=document)
+        index.source = vars(document).get("_rftk_source")
+        index.encoding = vars(document).get("_rftk_encoding")
+        document._rftk_index = index
+    return index
+
+
+def get_document_source(document=None):
+    """Returns the raw html bytes the document was parsed from, falling
+    back to the compact serialization of the tree."""
+    index = get_document_index(document)
+    if index.source is not None:
+        return index.source
+    if index.parser == "bs4":
+        return str(index.document).encode("utf-8")
+    return index.to_html().encode("utf-8")
+
+
+def get_document_html(document=None):
+    """Returns the html the document was parsed from as text, decoded
+    with the page's charset."""
+    index = get_document_index(document)
+    return decode_html(content=get_document_source(document),
+                       encoding=index.encoding)
+
+
+def store_html(fs_client=None, bucket_name=HTML_BUCKET, content=None,
+               compression=None):
+    """Utility function that compresses the html and stores it in GCS
+    under its sha256 digest, so identical pages are only stored once.
+
+    Returns the digest, the raw size and the object path, or None if
+    the upload failed."""
+    print("store_html()")
+    html_sha256 = hashlib.sha256(content).hexdigest()
+    path = "{}/html/{}".format(bucket_name, html_sha256)
+    try:
+        if fs_client.exists(path):
+            print("html already stored: {}".format(path))
+        else:
+            with fs_client.open(path, "wb") as f:
+                f.write(compress(data=content, method=compression))
+    except Exception as e:
+        err = {
+            "error_message": e,
+            "status_code": "error uploading html to gcs."
+        }
+        print(err)
+        return None
+    return MetadataMixin(
+        html_sha256=html_sha256,
+        html_bytes=len(content),
+        html_path=path
+    )
+
 
 def is_email_link(href=None):
     """Utility function to determine whether the supplied href attribute
@@ -47,21 +310,16 @@ def is_social_link(href=None):
 def get_emails(document=None):
     """Utility function to return emails from a document."""
     print("get_emails()")
-    _r = r"'<\S+?>'"
+    index = get_document_index(document)
     # this caught false-positives like 'rd@context'
     # _r = r"[\w\.-]+@[\w\.-]+"
     emails = list(
         set(
-            re.findall(
-                _r,
-                document.text) +
+            EMAIL_TEXT_RE.findall(index.text) +
             [
-                a["href"] for a in
-                document.find_all(
-                    "a",
-                    href=is_email_link
-            )
-             ]
+                href for href in index.anchors
+                if "mailto:" in href
+            ]
         )
     )
     return emails
@@ -71,18 +329,12 @@ def get_phones(document=None):
     """Utility function that returns any phone numbers found within the
     supplied document."""
     print("get_phones()")
-    _r = r'(?:(?:\+?([1-9]|[0-9][0-9]|[0-9][0-9][0-9])' \
-         r'\s*(?:[.-]\s*)?)?(?:\(\s*([2-9]1[02-9]|[2-9][02-8]1|[2-9]' \
-         r'[02-8][02-9])\s*\)|([0-9][1-9]|[0-9]1[02-9]|[2-9][02-8]1|' \
-         r'[2-9][02-8][02-9]))\s*(?:[.-]\s*)?)?([2-9]1[02-9]|[2-9]' \
-         r'[02-9]1|[2-9][02-9]{2})\s*(?:[.-]\s*)?([0-9]{4})(?:\s*' \
-         r'(?:#|x\.?|ext\.?|extension)\s*(\d+))?'
-    regex_captured_numbers = re.findall(_r, document.text)
+    index = get_document_index(document)
+    regex_captured_numbers = PHONE_RE.findall(index.text)
     phones = list(set([''.join(match) for
                        match in regex_captured_numbers] +
-                      [a["href"] for
-                       a in document.
-                      find_all("a", href=is_tel_link)]))
+                      [href for href in index.anchors
+                       if "tel:" in href]))
     # TODO: hack; fix in regex
     phones = [phone.strip("tel:") for phone in phones]
     return phones
@@ -93,10 +345,10 @@ def get_socials(document=None):
     supplied document."""
     print("get_socials()")
     # TODO: add regex back in later
+    index = get_document_index(document)
     socials = list(set(
         # re.findall(r'[\w\.-]+@[\w\.-]+', document.text) + [
-        [a["href"] for a in
-         document.find_all("a", href=is_social_link)]))
+        [href for href in index.anchors if is_social_link(href)]))
 
     return socials
 
@@ -110,12 +362,44 @@ def get_url(ip_address=None):
     # company is probably too big for our product
 
 
-def get_content_class(content=None):
+def get_language_client():
+    """Returns the process-wide `LanguageServiceClient`, creating it on
+    first use."""
+    global _LANGUAGE_CLIENT
+    if _LANGUAGE_CLIENT is None:
+        with _LANGUAGE_CLIENT_LOCK:
+            if _LANGUAGE_CLIENT is None:
+                _LANGUAGE_CLIENT = language.LanguageServiceClient()
+    return _LANGUAGE_CLIENT
+
+
+def normalize_text(content=None, max_chars=CLASSIFY_MAX_CHARS):
+    """Utility function that collapses the whitespace in the page text
+    and truncates it to the length worth sending for classification."""
+    text = " ".join(content.split())
+    if max_chars is not None:
+        text = text[:max_chars]
+    return text
+
+
+def get_content_class(content=None, cache=CLASSIFICATION_CACHE):
     """Utility function that takes website content and returns the
-    classification of that text by Google."""
+    classification of that text by Google.
+
+    The text is normalized by `normalize_text` and results are cached
+    by its digest, so identical pages are only classified once. Errors
+    are not cached."""
+    print("get_content_class()")
+    key = None
     try:
-        print("get_content_class()")
-        language_client = language.LanguageServiceClient()
+        content = normalize_text(content=content)
+        if cache is not None:
+            key = cache.get_key(content)
+            result = cache.get(key)
+            if result is not None:
+                return result
+
+        language_client = get_language_client()
 
         document = language.types.Document(
             content=content,
@@ -138,30 +422,53 @@ def get_content_class(content=None):
         result = {
             "An Exception Occurred": 0.0
         }
+        return result
+    if cache is not None:
+        cache.set(key, result)
     return result
 
 
+def classify_many(contents=None, cache=CLASSIFICATION_CACHE):
+    """Utility function that classifies many documents concurrently on
+    a bounded worker pool. Identical texts are only sent once. Returns
+    the results in the same order as `contents`."""
+    print("classify_many()")
+    futures = dict()
+    keys = list()
+    for content in contents:
+        try:
+            key = normalize_text(content=content)
+        except Exception as e:
+            # e.g. None; `get_content_class` returns the exception
+            # category for it
+            key = None
+        keys.append(key)
+        if key not in futures:
+            futures[key] = _CLASSIFY_EXECUTOR.submit(get_content_class,
+                                                     content=key,
+                                                     cache=cache)
+    return [futures[key].result() for key in keys]
+
+
 def get_wp_plugins(document=None):
     """Retrieves a list of the installed WP plugins."""
     print("get_wp_plugins()")
-    r = r"""(?<=wp-content\/plugins\/)(.*?)(?=\/)"""
-    plugin_links = document \
-        .find_all('link',
-                  {'href': re.compile(r)})
-    plugins_list = [re.findall(r, tag["href"])[0] for tag in
-                    plugin_links]
-    plugins_list = list(set(plugins_list))
+    index = get_document_index(document)
+    plugins_list = [WP_PLUGIN_RE.search(href) for href in index.link_hrefs
+                    if "wp-content/plugins/" in href]
+    plugins_list = list(set([m.group(1) for m in plugins_list
+                             if m is not None]))
     return plugins_list
 
 
 def get_wp_themes(document=None):
     """Returns the WP theme used on the site."""
     print("get_wp_themes()")
-    r = r"""(?<=wp-content\/themes\/)(.*?)(?=\/)"""
-    themes = document.find_all("link",
-                               {"href": re.compile(r)})
-    themes_list = [re.findall(r, tag["href"])[0] for tag in themes]
-    themes_list = list(set(themes_list))
+    index = get_document_index(document)
+    themes_list = [WP_THEME_RE.search(href) for href in index.link_hrefs
+                   if "wp-content/themes/" in href]
+    themes_list = list(set([m.group(1) for m in themes_list
+                            if m is not None]))
     return themes_list
 
 
@@ -169,17 +476,11 @@ def get_squarespace_context(document=None):
     """Returns the Squarespace template used on the site."""
     # this content contains all kinds of useful firmographic data.
     try:
-        script = document.find(
-            "script",
-            {"data-name": "static-context"}
-        )\
-        .getText(strip=True)
+        script = get_document_index(document)\
+            .get_script_text(name="static-context")
 
         # now parse out the context object
-        context = re.search(
-            "(?ms)Static\.SQUARESPACE_CONTEXT = ({.+?});",
-            script,
-        ).group(1)
+        context = SQUARESPACE_CONTEXT_RE.search(script).group(1)
         context = json.loads(context)
     except json.decoder.JSONDecodeError as e:
         print(e)
@@ -193,8 +494,7 @@ def get_squarespace_context(document=None):
 def get_all_links(document=None):
     """Function that returns all the links found on the visited page."""
     print("get_all_links()")
-    all_links = [a["href"]
-                 for a in document.find_all("a", href=True)]
+    all_links = get_document_index(document).anchors
     # remove empty strings
     all_links = [link for link in all_links if len(link) > 0 and
                  link != '/']
@@ -233,12 +533,10 @@ def get_external_links(internal_links=None,  all_links=None):
     print("get_external_links()")
     # TODO: clean this up to remove incorrect links like jquery,
     # tel:, etc.
-    _r = r"(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))" \
-         r"([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?"
     links = [link for link in all_links
              if link not in internal_links]
     # do some additional cleanup to remove jquery anchors, etc.
-    external_links = [re.findall(_r, link) for link in links]
+    external_links = [EXTERNAL_LINK_RE.findall(link) for link in links]
     # remove empty lists
     external_links = [link for link in external_links
                       if len(link) > 0]
@@ -263,44 +561,263 @@ def get_keywords_and_description(document=None):
     """Extracts the keywords and description from the `meta`
     tags."""
     print("get_keywords_and_description()")
-    keywords_ = document \
-        .find_all(name="meta",
-                  attrs={"name": "keywords"})
+    index = get_document_index(document)
+    keywords_ = index.metas.get("keywords", list())
 
     if len(keywords_) != 0:
-        keywords_ = keywords_[0]["content"] \
+        keywords_ = keywords_[0] \
             .split(",")
 
         keywords_ = [keyword.lstrip().rstrip() for keyword in keywords_]
 
-    description_ = document \
-        .find_all(name="meta",
-                  attrs={"name": "description"})
+    description_ = index.metas.get("description", list())
 
     if len(description_) != 0:
-        description_ = description_[0]["content"].replace("\r", " ")
+        description_ = description_[0].replace("\r", " ")
     return keywords_, description_
 
 
-def crawl_and_parse(url=None):
+def is_html_response(resp=None):
+    """Utility function to determine whether the response headers
+    describe an html page. Responses without a content-type are given
+    the benefit of the doubt."""
+    content_type = resp.headers.get("content-type")
+    if content_type is None:
+        return True
+    content_type = content_type.split(";")[0].strip().lower()
+    return content_type in HTML_CONTENT_TYPES
+
+
+def get_deadline_timeout(timeout=HTTP_TIMEOUT, deadline=None):
+    """Utility function that shortens the (connect, read) `timeout` to
+    end by the `deadline` (epoch seconds). Raises `Timeout` once the
+    deadline has passed."""
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise requests.exceptions.Timeout("exceeded the crawl deadline")
+    if isinstance(timeout, tuple):
+        return tuple(min(t, remaining) for t in timeout)
+    return min(timeout, remaining)
+
+
+def get_response_socket(resp=None):
+    """Utility function that returns the socket a streamed response is
+    read from, or None if it can't be found."""
+    sock = getattr(getattr(resp.raw, "_connection", None), "sock", None)
+    if sock is None:
+        try:
+            sock = resp.raw._fp.fp.raw._sock
+        except AttributeError:
+            pass
+    return sock
+
+
+def watch_deadline(resp=None, deadline=None):
+    """Utility function that shuts down the socket `resp` is streamed
+    from once the `deadline` (epoch seconds) passes. The read timeout
+    only applies to each `recv`, so a server trickling out the body
+    would otherwise hold the read open well past the deadline. Returns
+    the timer and an event that's set if it fired."""
+    expired = threading.Event()
+
+    def expire():
+        expired.set()
+        sock = get_response_socket(resp=resp)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    timer = threading.Timer(max(deadline - time.time(), 0.0), expire)
+    timer.daemon = True
+    timer.start()
+    return timer, expired
+
+
+def fetch_html(url=None, timeout=HTTP_TIMEOUT, max_bytes=CRAWL_MAX_BYTES,
+               max_redirects=CRAWL_MAX_REDIRECTS, head_only=False,
+               headers=None, deadline=None):
+    """Utility function that streams the page at the supplied url,
+    following at most `max_redirects` redirects and reading at most
+    `max_bytes` of the body. Returns the status code, the content and
+    the response headers.
+
+    Non-html responses are dropped before their bodies are read (the
+    content is returned as None) and, with `head_only`, the download
+    stops once `</head>` has been seen. `headers` are sent along with
+    the defaults, e.g. the validators for a conditional GET. With a
+    `deadline` (epoch seconds) the whole download, redirects included,
+    raises `Timeout` rather than run past it."""
+    print("fetch_html()")
+    session = get_session("crawler")
+    request_headers = HEADERS.copy()
+    if headers is not None:
+        request_headers.update(headers)
+    for _ in range(max_redirects + 1):
+        resp = session.get(url=url,
+                           headers=request_headers,
+                           stream=True,
+                           allow_redirects=False,
+                           timeout=get_deadline_timeout(
+                               timeout=timeout, deadline=deadline))
+        if not resp.is_redirect:
+            break
+        url = urljoin(resp.url, resp.headers["location"])
+        resp.close()
+    else:
+        raise requests.exceptions.TooManyRedirects(
+            "exceeded {} redirects".format(max_redirects))
+
+    try:
+        resp.raise_for_status()
+        # not modified since the validators we sent
+        if resp.status_code == 304:
+            return resp.status_code, b"", resp.headers
+        if not is_html_response(resp):
+            print("skipping {} with content-type: {}"
+                  .format(url, resp.headers.get("content-type")))
+            return resp.status_code, None, resp.headers
+
+        chunks = list()
+        n_bytes = 0
+        # keep the end of the previous chunk in case the closing tag
+        # straddles two chunks
+        tail = b""
+        watchdog, expired = None, None
+        if deadline is not None:
+            watchdog, expired = watch_deadline(resp=resp,
+                                               deadline=deadline)
+        try:
+            for chunk in resp.iter_content(chunk_size=CRAWL_CHUNK_SIZE):
+                if deadline is not None and time.time() > deadline:
+                    raise requests.exceptions.Timeout(
+                        "exceeded the crawl deadline")
+                chunks.append(chunk)
+                n_bytes += len(chunk)
+                if max_bytes is not None and n_bytes >= max_bytes:
+                    print("truncated {} at {} bytes"
+                          .format(url, max_bytes))
+                    break
+                if head_only is True:
+                    window = (tail + chunk).lower()
+                    if b"</head>" in window:
+                        print("stopped {} after </head>".format(url))
+                        break
+                    tail = window[-len(b"</head>"):]
+        except Exception:
+            # the read that was cut off fails however it likes
+            if expired is not None and expired.is_set():
+                raise requests.exceptions.Timeout(
+                    "exceeded the crawl deadline")
+            raise
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+        # or it can just end early, without an error
+        if expired is not None and expired.is_set():
+            raise requests.exceptions.Timeout(
+                "exceeded the crawl deadline")
+    finally:
+        resp.close()
+    content = b"".join(chunks)
+    if max_bytes is not None:
+        content = content[:max_bytes]
+    return resp.status_code, content, resp.headers
+
+
+def crawl_and_parse(url=None, timeout=HTTP_TIMEOUT,
+                    max_bytes=CRAWL_MAX_BYTES,
+                    max_redirects=CRAWL_MAX_REDIRECTS, parser=None,
+                    head_only=False, deadline=None):
     """Utility function to crawl and return the HTML from the
-    supplied domain."""
+    supplied domain, parsed with `parse_html`.
+
+    Pass `head_only=True` when only the meta, link and script
+    extractors will be run over the page, and a `deadline` (epoch
+    seconds) to bound the whole download."""
     print("crawl_and_parse()")
     try:
-        resp = requests.get(url=url,
-                            headers=HEADERS)
-        resp.raise_for_status()
+        status_code, content, headers = fetch_html(
+            url=url,
+            timeout=timeout,
+            max_bytes=max_bytes,
+            max_redirects=max_redirects,
+            head_only=head_only,
+            deadline=deadline
+        )
     except requests.exceptions.HTTPError as e:
-        resp = "Error: {}".format(e)
+        return "error: {}".format(e)
     except Exception as e:
-        resp = "Error: {}".format(e)
+        return "error: {}".format(e)
+
+    if content is None:
+        return "error: not an html page"
 
     # OK
-    if resp.status_code == 200:
-        return BeautifulSoup(resp.content,
-                             "html.parser")
+    if status_code == 200:
+        return parse_html(content=content,
+                          parser=parser,
+                          encoding=get_charset(
+                              headers.get("content-type")))
     else:
-        return "error: {}".format(resp)
+        return "error: status code {}".format(status_code)
+
+
+def crawl_if_changed(url=None, page_cache=None, timeout=HTTP_TIMEOUT,
+                     max_bytes=CRAWL_MAX_BYTES,
+                     max_redirects=CRAWL_MAX_REDIRECTS, parser=None):
+    """Utility function that refreshes a page with a conditional GET
+    against the `page_cache` entry for the url.
+
+    Returns a (document, cached, validators) tuple: `cached` is the
+    cache entry when the server answered 304 or the body hashes to the
+    cached digest (the page isn't parsed and `document` is None),
+    otherwise `document` is as returned by `crawl_and_parse`."""
+    print("crawl_if_changed()")
+    try:
+        status_code, content, headers = fetch_html(
+            url=url,
+            timeout=timeout,
+            max_bytes=max_bytes,
+            max_redirects=max_redirects,
+            headers=page_cache.get_conditional_headers(url=url)
+        )
+        # the entry the validators came from was evicted in the
+        # meantime, so there's nothing to reuse; fetch the page again
+        if status_code == 304 and page_cache.get(url=url) is None:
+            print("cache entry for {} is gone; refetching".format(url))
+            status_code, content, headers = fetch_html(
+                url=url,
+                timeout=timeout,
+                max_bytes=max_bytes,
+                max_redirects=max_redirects
+            )
+    except Exception as e:
+        return "error: {}".format(e), None, MetadataMixin()
+
+    validators = MetadataMixin(etag=headers.get("etag"),
+                               last_modified=headers.get("last-modified"))
+    html_sha256 = None
+    if content:
+        html_sha256 = hashlib.sha256(content).hexdigest()
+    cached = page_cache.get_unchanged(url=url,
+                                      status_code=status_code,
+                                      html_sha256=html_sha256)
+    if cached is not None:
+        return None, cached, validators
+
+    if content is None:
+        return "error: not an html page", None, validators
+    if status_code != 200:
+        return "error: status code {}".format(status_code), None, \
+            validators
+    document = parse_html(content=content,
+                          parser=parser,
+                          encoding=get_charset(headers.get("content-type")))
+    return document, None, validators
 
 
 def make_crawler_gcs_payload(request=None):
@@ -313,6 +830,10 @@ def make_crawler_gcs_payload(request=None):
     p["domain"] = r["domain"]
     p["url"] = r["url"]
     p["html_string"] = r["document"]
+    # missing from payloads made before the html was stored by digest
+    p["html_sha256"] = r.get("html_sha256")
+    p["html_bytes"] = r.get("html_bytes")
+    p["page_unchanged"] = r.get("page_unchanged", False)
     p["all_links"] = r["all_links"]
     p["internal_links"] = r["internal_links"]
     p["external_links"] = r["external_links"]
@@ -393,6 +914,10 @@ def make_crawler_bq_payload(request=None):
     p["domain"] = r["domain"]
     p["url"] = r["url"]
     p["html_string"] = r["html_string"]
+    # missing from payloads made before the html was stored by digest
+    p["html_sha256"] = r.get("html_sha256")
+    p["html_bytes"] = r.get("html_bytes")
+    p["page_unchanged"] = r.get("page_unchanged", False)
     p["ip_revealed"] = r["ip_revealed"]
     p["fuzzy_match"] = r["fuzzy_match"]
     p["all_links"] = " >>> ".join(
@@ -450,16 +975,17 @@ def wordpress_routines(request=None, has_html=True, is_parsed=False):
     # TODO: clean up the logic here
     if has_html is False:
         resp["url"] = request["url"]
-        # crawl the site and return the html for parsing
-        resp["document"] = crawl_and_parse(url=resp["url"])
+        # crawl the site and return the html for parsing; themes and
+        # plugins are found in the `link` tags so the head is enough
+        resp["document"] = crawl_and_parse(url=resp["url"],
+                                           head_only=True)
     elif has_html is True:
         # add the domain and url to the metadata container
         # resp["domain"] = request["domain"]
         if is_parsed is True:
             resp["document"] = request["document"]
         elif is_parsed is False:
-            resp["document"] = BeautifulSoup(request["document"],
-                                             "html.parser")
+            resp["document"] = parse_html(content=request["document"])
 
     try:
         # get the word press themes
@@ -477,8 +1003,9 @@ def wordpress_routines(request=None, has_html=True, is_parsed=False):
     return resp
 
 
-def squarespace_routines(request=None):
-    """Utility function containing"""
+def squarespace_routines(request=None, document=None):
+    """Utility function containing the squarespace enrichment
+    routines. Pass an already parsed `document` to skip the crawl."""
     print("squarespace_routines()")
 
     # container for holding the crawler results
@@ -488,8 +1015,12 @@ def squarespace_routines(request=None):
     resp["domain"] = request["domain"]
     resp["url"] = request["url"]
 
-    # crawl the site and return the html for parsing
-    resp["document"] = crawl_and_parse(url=resp["url"])
+    # crawl the site and return the html for parsing; the context
+    # script lives in the head
+    if document is None:
+        document = crawl_and_parse(url=resp["url"],
+                                   head_only=True)
+    resp["document"] = document
 
     # if the site is squarespace, we'll get the context object and
     # parse the info in it
@@ -499,9 +1030,24 @@ def squarespace_routines(request=None):
     return resp
 
 
-def domain_routines(request=None):
+def domain_routines(request=None, document=None, fs_client=None,
+                    bucket_name=HTML_BUCKET, page_cache=None,
+                    classifier=None):
     """Utility function containing the normal enrichment routines for
-    the webcrawler."""
+    the webcrawler. Pass an already parsed `document` to skip the
+    crawl.
+
+    With an `fs_client` the raw html is stored compressed in GCS by
+    `store_html` and only its digest and size are kept in the results;
+    otherwise the raw html is kept as the `document` string.
+
+    With a `page_cache` the page is refreshed with a conditional GET
+    and, when it hasn't changed, the cached results are returned with
+    `page_unchanged` set so the parse, the classification and the BQ
+    writes are all skipped.
+
+    `classifier` is any `classifiers.Classifier`; by default the page is
+    classified by `get_content_class`."""
     print("domain_routines()")
 
     # container for holding the crawler results
@@ -512,7 +1058,28 @@ def domain_routines(request=None):
     resp["url"] = request["url"]
 
     # crawl the site and return the html for parsing
-    resp["document"] = crawl_and_parse(url=resp["url"])
+    cached = None
+    validators = MetadataMixin()
+    if document is None and page_cache is not None:
+        document, cached, validators = \
+            crawl_if_changed(url=resp["url"],
+                             page_cache=page_cache)
+    elif document is None:
+        document = crawl_and_parse(url=resp["url"])
+    elif page_cache is not None and not isinstance(document, str):
+        cached = page_cache.get_unchanged(
+            url=resp["url"],
+            html_sha256=hashlib.sha256(
+                get_document_source(document)).hexdigest()
+        )
+
+    if cached is not None:
+        print("page unchanged: {}".format(resp["url"]))
+        resp.update(cached["results"])
+        resp["document"] = None
+        resp["page_unchanged"] = True
+        return resp
+    resp["document"] = document
 
     # get all links
     resp["all_links"] = get_all_links(document=resp["document"])
@@ -536,12 +1103,96 @@ def domain_routines(request=None):
         get_keywords_and_description(document=resp["document"])
 
     # get the content classification
-    resp["content_classification"] = \
-        get_content_class(content=resp["document"].text)
+    text = get_document_index(resp["document"]).text
+    if classifier is None:
+        resp["content_classification"] = get_content_class(content=text)
+    else:
+        resp["content_classification"] = classifier.predict(text=text)
+
+    # keep the raw bytes instead of a prettified copy of the tree
+    source = get_document_source(resp["document"])
+    stored = None
+    if fs_client is not None and bucket_name is not None:
+        stored = store_html(fs_client=fs_client,
+                            bucket_name=bucket_name,
+                            content=source)
+    if stored is not None:
+        resp["html_sha256"] = stored["html_sha256"]
+        resp["html_bytes"] = stored["html_bytes"]
+        resp["document"] = None
+    else:
+        resp["html_sha256"] = hashlib.sha256(source).hexdigest()
+        resp["html_bytes"] = len(source)
+        resp["document"] = get_document_html(resp["document"])
+    resp["page_unchanged"] = False
+
+    if page_cache is not None:
+        page_cache.set(
+            url=resp["url"],
+            html_sha256=resp["html_sha256"],
+            etag=validators.get("etag"),
+            last_modified=validators.get("last_modified"),
+            results={field: resp[field] for field in PAGE_CACHE_FIELDS}
+        )
+
+    return resp
 
-    # convert bs4 soup to plain string so we can convert it to json
-    resp["document"] = resp["document"].prettify()
 
+def site_routines(request=None, document=None, fs_client=None,
+                  bucket_name=HTML_BUCKET, page_cache=None,
+                  classifier=None):
+    """Utility function that crawls and parses the site once and runs
+    the domain, wordpress and squarespace routines over the same
+    document. `fs_client`, `bucket_name`, `page_cache` and `classifier`
+    are passed on to `domain_routines`."""
+    print("site_routines()")
+
+    # container for holding the results of each routine
+    resp = MetadataMixin()
+    resp["domain"] = request["domain"]
+    resp["url"] = request["url"]
+
+    start = time.time()
+    if document is None:
+        document = crawl_and_parse(url=resp["url"])
+        resp["fetches"] = 1
+    else:
+        resp["fetches"] = 0
+    resp["crawl_seconds"] = round(time.time() - start, 3)
+
+    if isinstance(document, str):
+        print("could not crawl {}: {}".format(resp["url"], document))
+        resp["error"] = document
+        resp["wordpress"] = None
+        resp["squarespace"] = None
+        resp["domain_results"] = None
+        return resp
+
+    start = time.time()
+    wp_request = request.copy()
+    wp_request["document"] = document
+    resp["wordpress"] = wordpress_routines(request=wp_request,
+                                           has_html=True,
+                                           is_parsed=True)
+    resp["wordpress"]["url"] = resp["url"]
+    resp["squarespace"] = squarespace_routines(request=request,
+                                               document=document)
+    resp["domain_results"] = domain_routines(request=request,
+                                             document=document,
+                                             fs_client=fs_client,
+                                             bucket_name=bucket_name,
+                                             page_cache=page_cache,
+                                             classifier=classifier)
+
+    # share the raw html rather than the parsed document
+    html = get_document_html(document)
+    resp["wordpress"]["document"] = html
+    resp["squarespace"]["document"] = html
+    resp["extract_seconds"] = round(time.time() - start, 3)
+    print("fetches: {}, crawl_seconds: {}, extract_seconds: {}"
+          .format(resp["fetches"],
+                  resp["crawl_seconds"],
+                  resp["extract_seconds"]))
     return resp
 
 
@@ -1,8 +1,8 @@
-import re
-
 import dns.resolver
 import dns.exception
 
+from .patterns import MX_PRIORITY_RE
+
 
 def get_email_provider(domain=None):
     """Performs the MX lookup for the specified domain."""
@@ -26,9 +26,7 @@ def get_email_provider(domain=None):
             for record in dns.resolver.query(domain, "MX"):
                 print("attempt: {}".format(n+1))
                 # get the current result and parse out the index value
-                result = re.sub("\d+\s",
-                                "",
-                                record.to_text())
+                result = MX_PRIORITY_RE.sub("", record.to_text())
                 print("mx_record: {}".format(result))
 
                 # append the raw record
@@ -0,0 +1,156 @@
+"""
+envelope.py: Versioned envelope for the messages sent over Pub/Sub.
+
+The message body is serialized with a codec ("json" or "msgpack") and
+optionally compressed; how it was encoded travels in the message
+attributes. Bodies without the attributes are sniffed instead, so
+producers and consumers can be moved to the envelope one at a time.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import hashlib
+import json
+import math
+
+# optional faster codecs
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .compression import compress, decompress, detect_compression
+from .constants import MESSAGE_CODEC, MESSAGE_COMPRESSION, \
+    MESSAGE_COMPRESS_MIN_BYTES, CLAIM_CHECK_PREFIX
+from .patterns import LONG_DIGITS_RE
+
+
+ENVELOPE_VERSION = "1"
+VERSION_ATTRIBUTE = "rftk_envelope"
+CODEC_ATTRIBUTE = "rftk_codec"
+COMPRESSION_ATTRIBUTE = "rftk_compression"
+CLAIM_CHECK_KEY = "rftk_claim_check"
+
+
+def has_non_finite(message=None):
+    """Returns True if the message holds a NaN or infinite float."""
+    stack = [message]
+    while len(stack) != 0:
+        value = stack.pop()
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return False
+
+
+def dumps(message=None, codec="json"):
+    """Serializes the message with the codec. JSON is written by
+    `orjson` when it's installed, except for messages `orjson` would
+    write differently from the stdlib: non-string keys and ints wider
+    than 64 bits (which it rejects) and NaN/Infinity (which it writes
+    as null)."""
+    if codec == "json":
+        if orjson is not None:
+            try:
+                data = orjson.dumps(message)
+            except TypeError:
+                # e.g. non-string keys; fall back to the stdlib
+                data = None
+            # only a message with nulls in it can hold a NaN
+            if data is not None and (b"null" not in data or
+                                     not has_non_finite(message)):
+                return data
+        return str.encode(json.dumps(message))
+    if codec == "msgpack":
+        if msgpack is None:
+            raise ValueError("the msgpack codec requires `msgpack`")
+        return msgpack.packb(message, use_bin_type=True)
+    raise ValueError("unknown codec: {}".format(codec))
+
+
+def loads(data=None, codec="json"):
+    """Deserializes bytes written by `dumps`. JSON is read by `orjson`
+    when it's installed, except for bodies it would read differently
+    from the stdlib: any with a run of 19 or more digits, which could be
+    an int wider than 64 bits that `orjson` turns into a float, and
+    NaN/Infinity, which it rejects."""
+    if codec == "json":
+        if orjson is not None and LONG_DIGITS_RE.search(data) is None:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+        return json.loads(data.decode("utf-8"))
+    if codec == "msgpack":
+        if msgpack is None:
+            raise ValueError("the msgpack codec requires `msgpack`")
+        return msgpack.unpackb(data, raw=False)
+    raise ValueError("unknown codec: {}".format(codec))
+
+
+def detect_codec(data=None):
+    """Guesses the codec of an uncompressed body: JSON messages are
+    objects or arrays, anything else is taken to be msgpack."""
+    if data.lstrip()[:1] in (b"{", b"["):
+        return "json"
+    return "msgpack"
+
+
+def encode_message(message=None, codec=MESSAGE_CODEC,
+                   compression=MESSAGE_COMPRESSION,
+                   compress_min_bytes=MESSAGE_COMPRESS_MIN_BYTES):
+    """Encodes the message into the envelope. Returns the body bytes
+    and the attributes to publish alongside it.
+
+    Bodies smaller than `compress_min_bytes` are left uncompressed."""
+    data = dumps(message=message, codec=codec)
+    if compression != "none" and len(data) < compress_min_bytes:
+        compression = "none"
+    data = compress(data=data, method=compression)
+    attributes = {
+        VERSION_ATTRIBUTE: ENVELOPE_VERSION,
+        CODEC_ATTRIBUTE: codec,
+        # the compression may have defaulted to zstd or gzip
+        COMPRESSION_ATTRIBUTE: detect_compression(data)
+    }
+    return data, attributes
+
+
+def decode_message(data=None, attributes=None):
+    """Decodes a body written by `encode_message`, or a plain JSON
+    body from a producer that doesn't use the envelope yet."""
+    attributes = dict() if attributes is None else attributes
+    if attributes.get(VERSION_ATTRIBUTE) == ENVELOPE_VERSION:
+        data = decompress(data=data,
+                          method=attributes[COMPRESSION_ATTRIBUTE])
+        return loads(data=data, codec=attributes[CODEC_ATTRIBUTE])
+    data = decompress(data=data)
+    return loads(data=data, codec=detect_codec(data))
+
+
+def make_claim_check(message=None, data=None, bucket_name=None):
+    """Returns the GCS file name for the message body and the pointer
+    message to publish in its place. The body is named by its digest so
+    retried uploads overwrite the same object."""
+    file_name = CLAIM_CHECK_PREFIX + hashlib.sha256(data).hexdigest()
+    pointer = {
+        "topic": message["topic"],
+        CLAIM_CHECK_KEY: {
+            "bucket_name": bucket_name,
+            "file_name": file_name + ".json",
+            "bytes": len(data)
+        }
+    }
+    return file_name, pointer
+
+
+def is_claim_check(message=None):
+    """Returns True if the message is a claim-check pointer."""
+    return isinstance(message, dict) and CLAIM_CHECK_KEY in message
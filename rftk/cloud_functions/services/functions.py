@@ -6,17 +6,33 @@ __author__ = "Jason Wolosonovich <jason@avaland.io>"
 __license__ = "BSD 3 clause"
 
 import time
-import re
 import base64
 import json
 import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
 
 import requests
+from cachetools import TTLCache
 import google.cloud.pubsub as ps
 import google.cloud.bigquery as bq
 import validators
 
+from .classes import MetadataMixin, BatchedRowWriter, LatencyHistogram, \
+    TokenBucket, PublishStats
+from .constants import HTTP_TIMEOUT, URL_CACHE_TTL, URL_CACHE_MAXSIZE, \
+    URL_FAILURE_CACHE_TTL, \
+    URL_PROBE_WORKERS, BULK_CHUNK_SIZE, BULK_MEMO_MAXSIZE, \
+    REFINERY_ID_MEMO_MAXSIZE, PUBSUB_PROJECT, PUBLISH_TIMEOUT, \
+    MESSAGE_CODEC, MESSAGE_COMPRESSION, CLAIM_CHECK_BYTES, \
+    CLAIM_CHECK_BUCKET, MAX_RETRIES, GCS_MAX_WORKERS, GCS_RETRY_BACKOFF
 from .crawler_service import HEADERS
+from .envelope import encode_message, decode_message, make_claim_check, \
+    is_claim_check, CLAIM_CHECK_KEY
+from .patterns import EMAIL_RE, EMAIL_DOMAIN_RE
+from .sessions import get_session, get_fs_client
 
 
 def upload_to_gcs(fs_client=None, payload=None, bucket_name=None,
@@ -114,83 +130,359 @@ def download_from_gcs(fs_client=None, bucket_name=None,
     # return
 
 
-def callback(future):
-    """Callback function to ensure the future has completed."""
-    message_id = future.result()
-    print("message_id: {} received.".format(message_id))
-    return "OK, 200"
+def retry_with_backoff(fn=None, max_retries=MAX_RETRIES,
+                       backoff=GCS_RETRY_BACKOFF):
+    """Utility function that calls `fn` until it succeeds, sleeping
+    `backoff` seconds (doubled each time) between attempts. Returns
+    ("OK, 200", result) or (error message, None)."""
+    for n in range(max_retries):
+        try:
+            return "OK, 200", fn()
+        except Exception as e:
+            error = "{}: {}".format(type(e).__name__, e)
+            if n < max_retries - 1:
+                time.sleep(backoff * 2 ** n)
+    return error, None
+
+
+def upload_many_to_gcs(fs_client=None, payloads=None, bucket_name=None,
+                       file_suffix="", max_workers=GCS_MAX_WORKERS,
+                       max_retries=MAX_RETRIES, statuses=None):
+    """Utility function that uploads many json payloads to GCS at once.
+
+    `payloads` maps each file name to its payload. Uploads run on at
+    most `max_workers` threads and each is retried `max_retries` times.
+    Returns a `MetadataMixin` mapping every file name to "OK, 200" or
+    the last error; pass it back as `statuses` to resume a partially
+    failed run, uploading only what hasn't succeeded yet."""
+    print("upload_many_to_gcs()")
+    start = time.time()
+    statuses = MetadataMixin() if statuses is None \
+        else MetadataMixin(statuses)
+    pending = [file_name for file_name in payloads
+               if statuses.get(file_name) != "OK, 200"]
+
+    def upload(file_name=None):
+        def write():
+            with fs_client.open(bucket_name + "/" + file_name + file_suffix,
+                                "w") as f:
+                f.write(json.dumps(payloads[file_name]))
+        return retry_with_backoff(fn=write, max_retries=max_retries)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for file_name, (status, _) in zip(pending,
+                                          executor.map(upload, pending)):
+            statuses[file_name] = status
+
+    n_failed = len([s for s in statuses.values() if s != "OK, 200"])
+    print("objects uploaded: {}".format(len(pending) - n_failed))
+    print("objects failed: {}".format(n_failed))
+    print("time elapsed (seconds): {0:.1f}".format(time.time() - start))
+    return statuses
+
+
+def download_many_from_gcs(fs_client=None, bucket_name=None,
+                           file_names=None, max_workers=GCS_MAX_WORKERS,
+                           max_retries=MAX_RETRIES, statuses=None,
+                           payloads=None):
+    """Utility function that downloads many objects from GCS at once.
+
+    Downloads run on at most `max_workers` threads and each is retried
+    `max_retries` times. Returns the payloads as a dict of file name ->
+    bytes and a `MetadataMixin` mapping every file name to "OK, 200" or
+    the last error; pass both back as `statuses` and `payloads` to
+    resume a partially failed run."""
+    print("download_many_from_gcs()")
+    start = time.time()
+    statuses = MetadataMixin() if statuses is None \
+        else MetadataMixin(statuses)
+    payloads = dict() if payloads is None else dict(payloads)
+    pending = [file_name for file_name in file_names
+               if statuses.get(file_name) != "OK, 200"]
+
+    def download(file_name=None):
+        return retry_with_backoff(
+            fn=lambda: fs_client.cat(bucket_name + "/" + file_name),
+            max_retries=max_retries
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for file_name, (status, payload) in \
+                zip(pending, executor.map(download, pending)):
+            statuses[file_name] = status
+            if payload is not None:
+                payloads[file_name] = payload
+
+    n_failed = len([s for s in statuses.values() if s != "OK, 200"])
+    print("objects downloaded: {}".format(len(pending) - n_failed))
+    print("objects failed: {}".format(n_failed))
+    print("time elapsed (seconds): {0:.1f}".format(time.time() - start))
+    return payloads, statuses
+
+
+# batch settings -> publisher, topic -> topic path and (topic, rate) ->
+# token bucket, shared across warm invocations
+_PUBLISHERS = dict()
+_TOPIC_PATHS = dict()
+_TOPIC_LIMITERS = dict()
+_PUBLISHERS_LOCK = threading.Lock()
+
+
+def get_publisher(max_bytes=10000000, max_latency=0.05,
+                  max_messages=1000):
+    """Returns the process-wide `PublisherClient` for the batch
+    settings, creating it on first use."""
+    key = (max_bytes, max_latency, max_messages)
+    with _PUBLISHERS_LOCK:
+        if key not in _PUBLISHERS:
+            batch_settings = ps.types.BatchSettings(
+                max_bytes=max_bytes,
+                max_latency=max_latency,
+                max_messages=max_messages
+            )
+            _PUBLISHERS[key] = ps.PublisherClient(
+                batch_settings=batch_settings
+            )
+    return _PUBLISHERS[key]
+
+
+def get_topic_path(publisher=None, topic=None):
+    """Returns the full path of the topic in the project."""
+    topic_path = _TOPIC_PATHS.get(topic)
+    if topic_path is None:
+        topic_path = publisher.topic_path(PUBSUB_PROJECT, topic)
+        _TOPIC_PATHS[topic] = topic_path
+    return topic_path
+
+
+def get_topic_limiter(topic=None, kind=None, rate=None):
+    """Returns the process-wide token bucket limiting the topic to
+    `rate` messages ("messages") or bytes ("bytes") per second, or None
+    when there's no limit (a `rate` of None, 0 or less)."""
+    if rate is None or rate <= 0:
+        return None
+    key = (topic, kind, rate)
+    with _PUBLISHERS_LOCK:
+        if key not in _TOPIC_LIMITERS:
+            _TOPIC_LIMITERS[key] = TokenBucket(rate=rate)
+    return _TOPIC_LIMITERS[key]
+
+
+def upload_claim_check(fs_client=None, message=None, bucket_name=None,
+                       file_name=None):
+    """Utility function to write a claim-checked message body to GCS.
+    Unlike `upload_to_gcs` the payload isn't logged, as these are the
+    messages too large to publish."""
+    print("upload_claim_check()")
+    try:
+        with fs_client.open(bucket_name + "/" + file_name, "w") as f:
+            f.write(json.dumps(message))
+        print("claim-check: {}/{}".format(bucket_name, file_name))
+        return "OK, 200"
+    except Exception as e:
+        err = {
+            "error_message": e,
+            "status_code": "error uploading claim-check to gcs."
+        }
+        print(err)
+    return "SEE ERROR LOGS"
 
 
 def publish_to_endpoint(messages=None,
                         max_bytes=10000000,
                         max_latency=0.05, max_messages=1000,
-                        delay_length_in_seconds=None):
+                        delay_length_in_seconds=None,
+                        timeout=PUBLISH_TIMEOUT, codec=MESSAGE_CODEC,
+                        compression=MESSAGE_COMPRESSION, fs_client=None,
+                        claim_check_bucket=CLAIM_CHECK_BUCKET,
+                        claim_check_bytes=CLAIM_CHECK_BYTES,
+                        max_messages_per_second=None,
+                        max_bytes_per_second=None):
+    """Publishes the messages to the topic named in each message and
+    blocks until every publish has completed or `timeout` seconds have
+    passed since the last one was sent, so nothing is left in flight
+    when the instance is frozen.
+
+    Returns a `PublishStats` with the `status` ("OK, 200" when every
+    message was published), the number `published`, the indices into
+    `messages` of those that failed or timed out in `failed_indices`
+    (not Pub/Sub message ids), the `bytes` published and the publish
+    latency percentiles. It compares equal to its `status`, so
+    `publish_to_endpoint(...) == "OK, 200"` works as it did when the
+    status string was returned.
+
+    Messages are encoded by `envelope.encode_message` with the `codec`
+    and `compression`, which are sent as message attributes for
+    `decode_event`.
+
+    With an `fs_client` and a `claim_check_bucket`, any message that
+    encodes to more than `claim_check_bytes` is written to GCS with
+    `upload_claim_check` and a small pointer is published in its place (see
+    `resolve_claim_check`); their number is returned as
+    `claim_checks`.
+
+    Publishing to each topic is limited to `max_messages_per_second`
+    and `max_bytes_per_second` by token buckets that persist across
+    invocations; the wait happens before each `publish` call, never in
+    the publisher's batching threads, and is returned as `rate_limit`.
+    `delay_length_in_seconds` is kept for existing callers and means
+    `max_messages` per `delay_length_in_seconds`; 0 (or less) means no
+    delay."""
     print("publish_to_endpoint()")
-    messages_published = 0
     start = time.time()
-    # apply the batch settings if specified
-    batch_settings = ps.types.BatchSettings(
-        max_bytes=max_bytes,
-        max_latency=max_latency,
-        max_messages=max_messages
-    )
-    pubsub_client = ps.PublisherClient(
-        batch_settings=batch_settings
-    )
-    # TODO: find a universal way to encode the message so we don't
-    #  have to write different decoding functions in the_refinery to
-    #  deal with different publishers; this produces a dict,
-    #  but product and marketing will be delivering different payloads
-    n = 1
+    pubsub_client = get_publisher(max_bytes=max_bytes,
+                                  max_latency=max_latency,
+                                  max_messages=max_messages)
+    latencies = LatencyHistogram()
+    waits = LatencyHistogram()
+    if delay_length_in_seconds is not None and \
+            delay_length_in_seconds > 0 and \
+            max_messages_per_second is None:
+        max_messages_per_second = max_messages / delay_length_in_seconds
     if isinstance(messages, list):
         pass
     else:
         messages = [messages]
-    for message in messages:
-        byte_encoded_message = str.encode(
-            json.dumps(
-                message
-            )
+
+    def record_latency(published_at):
+        def done(future):
+            latencies.record(time.time() - published_at)
+        return done
+
+    futures = list()
+    n_bytes = list()
+    failed_indices = list()
+    n_claim_checks = 0
+    for i, message in enumerate(messages):
+        byte_encoded_message, attributes = encode_message(
+            message=message,
+            codec=codec,
+            compression=compression
         )
+        if fs_client is not None and claim_check_bucket is not None and \
+                len(byte_encoded_message) > claim_check_bytes:
+            file_name, pointer = make_claim_check(
+                message=message,
+                data=byte_encoded_message,
+                bucket_name=claim_check_bucket
+            )
+            status = upload_claim_check(fs_client=fs_client,
+                                        message=message,
+                                        bucket_name=claim_check_bucket,
+                                        file_name=file_name + ".json")
+            if status != "OK, 200":
+                print("message {} failed: claim-check upload".format(i))
+                failed_indices.append(i)
+                futures.append(None)
+                n_bytes.append(0)
+                continue
+            n_claim_checks += 1
+            byte_encoded_message, attributes = encode_message(
+                message=pointer,
+                codec=codec,
+                compression=compression
+            )
         # print("topic: {}".format(message["topic"]))
-        topic = pubsub_client.topic_path("infusionsoft-looker-poc",
-                                         message["topic"])
-        future = pubsub_client.publish(topic,
-                                       byte_encoded_message)
-
-        # attach the callback
-        future.add_done_callback(callback)
-
-        # add some rate-limiting
-        # if delay_length_in_seconds is not None:
-        #     if n % max_messages == 0:
-        #         time.sleep(delay_length_in_seconds)
+        topic = get_topic_path(publisher=pubsub_client,
+                               topic=message["topic"])
+
+        wait = 0.0
+        limiter = get_topic_limiter(topic=message["topic"],
+                                    kind="messages",
+                                    rate=max_messages_per_second)
+        if limiter is not None:
+            wait = limiter.reserve(amount=1)
+        limiter = get_topic_limiter(topic=message["topic"],
+                                    kind="bytes",
+                                    rate=max_bytes_per_second)
+        if limiter is not None:
+            wait = max(wait, limiter.reserve(
+                amount=len(byte_encoded_message)))
+        waits.record(wait)
+        if wait > 0:
+            time.sleep(wait)
 
-        # increment our counter
-        n += 1
-        messages_published += 1
-    print("messages published: {}".format(messages_published))
+        future = pubsub_client.publish(topic,
+                                       byte_encoded_message,
+                                       **attributes)
+        future.add_done_callback(record_latency(time.time()))
+        futures.append(future)
+        n_bytes.append(len(byte_encoded_message))
+
+    # flush: wait on every future, sharing one deadline
+    deadline = time.time() + timeout
+    published_bytes = 0
+    for i, future in enumerate(futures):
+        if future is None:
+            continue
+        try:
+            future.result(timeout=max(deadline - time.time(), 0))
+            published_bytes += n_bytes[i]
+        except Exception as e:
+            print("message {} failed: {!r}".format(i, e))
+            failed_indices.append(i)
+    failed_indices.sort()
+
+    stats = PublishStats(
+        status="OK, 200" if len(failed_indices) == 0 else "SEE ERROR LOGS",
+        published=len(futures) - len(failed_indices),
+        failed_indices=failed_indices,
+        bytes=published_bytes,
+        claim_checks=n_claim_checks,
+        seconds=round(time.time() - start, 3),
+        latency=latencies.get_stats(),
+        rate_limit=MetadataMixin(
+            seconds_waited=round(waits.total, 3),
+            wait=waits.get_stats()
+        )
+    )
+    print("messages published: {}".format(stats["published"]))
+    print("messages failed: {}".format(len(failed_indices)))
     print("time elapsed (seconds): {0:.1f}"
           .format(time.time() - start))
-
-    end = time.time()
-    print("total publishing time: {0:.1f}".format((end - start) / 60.))
-    return "OK, 200"
-
-
-def decode_event(event):
-    """Utility function for decoding the request."""
+    return stats
+
+
+def resolve_claim_check(request=None, fs_client=None):
+    """Utility function that swaps a claim-check pointer for the
+    message body stored in GCS. Anything else is returned as is.
+
+    Raises an `IOError` if the body can't be downloaded, so the message
+    isn't acknowledged and Pub/Sub redelivers it."""
+    print("resolve_claim_check()")
+    if not is_claim_check(request):
+        return request
+    claim_check = request[CLAIM_CHECK_KEY]
+    payload = download_from_gcs(fs_client=fs_client,
+                                bucket_name=claim_check["bucket_name"],
+                                file_name=claim_check["file_name"])
+    if payload == "SEE ERROR LOGS":
+        raise IOError("couldn't download the claim-check {}/{}".format(
+            claim_check["bucket_name"], claim_check["file_name"]))
+    return json.loads(payload)
+
+
+def decode_event(event, fs_client=None, project_name=None):
+    """Utility function for decoding the request. The format is taken
+    from the message attributes set by `publish_to_endpoint`, or
+    detected for messages published without them.
+
+    Claim-check pointers are resolved with the `fs_client`, or with the
+    process-wide filesystem for `project_name` (see `get_fs_client`)
+    when none is supplied."""
     # decode the message string
     print("decode_event()")
     request = base64.b64decode(
         event["data"]
-    ).decode(
-        'utf-8'
     )
-    # TODO: see if there is some in-built way in flask to handle all
-    #  this in a one-liner
-    # convert the message string to a dict
-    request = json.loads(request)
+    # convert the message to a dict
+    request = decode_message(data=request,
+                             attributes=event.get("attributes"))
+    if is_claim_check(request):
+        if fs_client is None:
+            fs_client = get_fs_client(project_name=project_name)
+        request = resolve_claim_check(request=request,
+                                      fs_client=fs_client)
     print("event: {}".format(request))
     return request
 
@@ -237,31 +529,102 @@ def get_service_params(request=None):
     return publisher, services, service_urls
 
 
+# domain -> resolved url shared across warm invocations; domains that
+# couldn't be resolved are remembered for a much shorter time as the
+# failure may be temporary
+URL_CACHE = TTLCache(maxsize=URL_CACHE_MAXSIZE, ttl=URL_CACHE_TTL)
+URL_FAILURE_CACHE = TTLCache(maxsize=URL_CACHE_MAXSIZE,
+                             ttl=URL_FAILURE_CACHE_TTL)
+_URL_CACHE_LOCK = threading.Lock()
+_URL_PROBE_EXECUTOR = ThreadPoolExecutor(max_workers=URL_PROBE_WORKERS)
+
+
+def probe_url(url=None):
+    """Utility function that returns the status code of the url without
+    downloading the page body."""
+    session = get_session("crawler")
+    try:
+        resp = session.head(url,
+                            headers=HEADERS,
+                            allow_redirects=True,
+                            timeout=HTTP_TIMEOUT)
+        status_code = resp.status_code
+        resp.close()
+        # plenty of servers mishandle HEAD so fall back to a streamed
+        # GET that is closed as soon as the headers arrive
+        if status_code != 200:
+            resp = session.get(url,
+                               headers=HEADERS,
+                               stream=True,
+                               timeout=HTTP_TIMEOUT)
+            status_code = resp.status_code
+            resp.close()
+    except requests.exceptions.RequestException as e:
+        print("could not probe url {}: {}".format(url, e))
+        status_code = None
+    print("status code for {}: {}".format(url, status_code))
+    return status_code
+
+
+def get_candidate_urls(domain=None):
+    """Utility function that returns the urls worth probing for the
+    supplied domain, with and without the `www.` prefix."""
+    domain = domain.lower()
+    if domain.startswith("www."):
+        hosts = [domain, domain[4:]]
+    else:
+        hosts = ["www." + domain, domain]
+    return [scheme + host
+            for host in hosts
+            for scheme in ["http://", "https://"]]
+
+
+def resolve_url(candidates=None):
+    """Utility function that probes the candidate urls concurrently and
+    returns the first one, in the order given, that responds with a
+    200. A url is returned as soon as it and every url ahead of it have
+    been probed."""
+    print("resolve_url()")
+    futures = [_URL_PROBE_EXECUTOR.submit(probe_url, url=url)
+               for url in candidates]
+    for i, future in enumerate(futures):
+        if future.result() == 200:
+            # the lower priority probes finish in the background
+            for other in futures[i + 1:]:
+                other.cancel()
+            return candidates[i]
+    return None
+
+
 def get_valid_url(domain=None):
     """Utility function that produces (when possible) a valid url
-    from a domain name."""
+    from a domain name.
+
+    The candidate schemes and hosts are probed concurrently, with
+    `http://www.` preferred, and resolved urls are cached for
+    `URL_CACHE_TTL` seconds (failures for `URL_FAILURE_CACHE_TTL`), so
+    repeat leads on the same domain don't hit the network again."""
     # TODO: add more robust exception handling
     print("get_valid_url()")
+    if not isinstance(domain, str):
+        print("domain is not valid")
+        return None
+    cache_key = domain.strip().lower()
+    with _URL_CACHE_LOCK:
+        for cache in (URL_CACHE, URL_FAILURE_CACHE):
+            if cache_key in cache:
+                url = cache[cache_key]
+                print("cached url: {}".format(url))
+                return url
+
     # NOTE: probably not robust to edge-cases
     # this may already be a valid url
     is_valid_url = validators.url(domain)
 
     if is_valid_url is True:
         print("domain is a valid url")
-        url = domain
         # there are edge-cases where this will still pass
-        try:
-            resp = requests.get(url,
-                                headers=HEADERS)
-            print("status code: {}".format(resp.status_code))
-            # one last check for status
-            if resp.status_code != 200:
-                print("could not get url: {}".format(url))
-                url = None
-        except requests.exceptions.HTTPError as e:
-            url = None
-        except Exception as e:
-            url = None
+        url = resolve_url(candidates=[domain])
 
     # validation failed
     else:
@@ -274,49 +637,17 @@ def get_valid_url(domain=None):
             print("domain is not valid")
             url = None
         else:
-            # try to construct a valid url
-            if domain.lower().startswith("www."):
-                url = "http://" + domain.lower()
-            else:
-                url = "http://www." + domain.lower()
-            print("constructed url: {}".format(url))
-
-            # one more validation check then try to open the url
-            is_valid_url = validators.url(url)
-
-            print("is_valid_url: {}".format(is_valid_url))
-            # now try to open the url as a final check
-            try:
-                resp = requests.get(url,
-                                    headers=HEADERS)
-                print("status code: {}".format(resp.status_code))
-                # one last check for status
-                if resp.status_code != 200:
-                    print("could not get url: {}".format(url))
-                    # try https then
-                    # try to construct a valid url
-                    print("trying https instead")
-                    if domain.lower().startswith("www."):
-                        url = "https://" + domain.lower()
-                    else:
-                        url = "https://www." + domain.lower()
-                    try:
-                        resp = requests.get(url,
-                                            headers=HEADERS)
-                        print("status code: {}"
-                              .format(resp.status_code))
-                        if resp.status_code != 200:
-                            print("could not get https url: {}"
-                                  .format(url))
-                            url = None
-                    except requests.exceptions.HTTPError as e:
-                        url = None
-                    except Exception as e:
-                        url = None
-            except requests.exceptions.HTTPError as e:
-                url = None
-            except Exception as e:
-                url = None
+            candidates = get_candidate_urls(domain=domain)
+            print("candidate urls: {}".format(candidates))
+            url = resolve_url(candidates=candidates)
+
+    if url is None:
+        print("could not get url for: {}".format(domain))
+    with _URL_CACHE_LOCK:
+        if url is None:
+            URL_FAILURE_CACHE[cache_key] = url
+        else:
+            URL_CACHE[cache_key] = url
     return url
 
 
@@ -325,11 +656,8 @@ def is_valid_email(email=None):
     # source: https://stackoverflow.com/questions/201323/how-to-validate-an-email-address-using-a-regular-expression
     # TODO: implement the python equivalent of the state machine
     #  found here: https://github.com/cubiclesoft/ultimate-email
-    r = re.compile(
-        """(?:[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*|"(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21\x23-\x5b\x5d-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])*")@(?:(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?|\[(?:(?:(2(5[0-5]|[0-4][0-9])|1[0-9][0-9]|[1-9]?[0-9]))\.){3}(?:(2(5[0-5]|[0-4][0-9])|1[0-9][0-9]|[1-9]?[0-9])|[a-z0-9-]*[a-z0-9]:(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21-\x5a\x53-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])+)\])"""
-    )
     try:
-        is_valid = False if re.match(r, email) is None else True
+        is_valid = False if EMAIL_RE.match(email) is None else True
     except Exception as e:
         print(e)
         is_valid = False
@@ -338,11 +666,8 @@ def is_valid_email(email=None):
 
 def get_domain_from_email(email=None):
     """Returns the domain from the provided email address."""
-    r = re.compile(
-        """^(.*@)([\w.]+)"""
-    )
     try:
-        domain = re.match(r, email).group(2)
+        domain = EMAIL_DOMAIN_RE.match(email).group(2)
         print("domain: {}".format(domain))
     except Exception as e:
         print(e)
@@ -350,24 +675,162 @@ def get_domain_from_email(email=None):
     return domain
 
 
+def map_in_chunks(values=None, fn=None, dtype=None,
+                  chunk_size=BULK_CHUNK_SIZE, memo_maxsize=BULK_MEMO_MAXSIZE):
+    """Utility function that applies `fn` to every value, `chunk_size`
+    values at a time, and returns the results as a numpy array.
+
+    `values` may be any iterable, list, numpy array or pandas Series.
+    Results are memoized so repeated values are only computed once; the
+    memo is cleared whenever it grows past `memo_maxsize`."""
+    # imported here as it's slow to import and only the bulk functions
+    # need it
+    import numpy as np
+    # numpy and pandas hand back python objects much faster in bulk
+    if hasattr(values, "tolist"):
+        values = values.tolist()
+    values = iter(values)
+    memo = dict()
+    chunks = list()
+    while True:
+        chunk = list(islice(values, chunk_size))
+        if len(chunk) == 0:
+            break
+        results = list()
+        for value in chunk:
+            try:
+                result = memo[value]
+            except KeyError:
+                result = memo[value] = fn(value)
+            except TypeError:
+                # unhashable
+                result = fn(value)
+            results.append(result)
+        chunks.append(np.array(results, dtype=dtype))
+        if len(memo) > memo_maxsize:
+            memo.clear()
+    if len(chunks) == 0:
+        return np.array(list(), dtype=dtype)
+    return np.concatenate(chunks)
+
+
+def _is_valid_email(email=None):
+    if not isinstance(email, str):
+        return False
+    return EMAIL_RE.match(email) is not None
+
+
+def _get_domain_from_email(email=None):
+    if not isinstance(email, str):
+        return None
+    match = EMAIL_DOMAIN_RE.match(email)
+    return None if match is None else match.group(2)
+
+
+def are_valid_emails(emails=None, chunk_size=BULK_CHUNK_SIZE):
+    """Bulk version of `is_valid_email`. Returns a boolean mask with an
+    entry for each of the `emails`; anything that isn't a string (None,
+    NaN) is invalid."""
+    print("are_valid_emails()")
+    return map_in_chunks(values=emails,
+                         fn=_is_valid_email,
+                         dtype=bool,
+                         chunk_size=chunk_size)
+
+
+def get_domains_from_emails(emails=None, chunk_size=BULK_CHUNK_SIZE):
+    """Bulk version of `get_domain_from_email`. Returns an object array
+    of domains with None wherever no domain could be extracted."""
+    print("get_domains_from_emails()")
+    return map_in_chunks(values=emails,
+                         fn=_get_domain_from_email,
+                         dtype=object,
+                         chunk_size=chunk_size)
+
+
+@lru_cache(maxsize=REFINERY_ID_MEMO_MAXSIZE)
+def _hash_id(value=None):
+    """The sha256 hexdigest every refinery id is made from, memoized
+    since the same company domain turns up for every one of its
+    leads."""
+    return hashlib.sha256(
+        value.encode("utf-8")
+    ).hexdigest()
+
+
+def _make_id(value=None):
+    if not isinstance(value, str):
+        return None
+    return _hash_id(value)
+
+
+def _make_ids(values=None):
+    # module level so it can be sent to the process pool
+    return [_hash_id(value) for value in values]
+
+
 def generate_refinery_id(id_type=None, domain=None, email=None):
     if id_type == "company":
-        id =  hashlib.sha256(
-            domain.encode("utf-8")
-        ).hexdigest()
+        id = _hash_id(domain)
     elif id_type == "person":
-        id = hashlib.sha256(
-            email.encode("utf-8")
-        ).hexdigest()
+        id = _hash_id(email)
     return id
 
 
+def generate_refinery_ids(id_type=None, domains=None, emails=None,
+                          n_processes=None, chunk_size=BULK_CHUNK_SIZE):
+    """Bulk version of `generate_refinery_id`: returns an object array
+    with the id for each of the `domains` ("company") or `emails`
+    ("person"), and None for anything that isn't a string.
+
+    With `n_processes` the distinct values are hashed on a process pool
+    in chunks of `chunk_size`, which only pays off for very large
+    batches."""
+    print("generate_refinery_ids()")
+    if id_type == "company":
+        values = domains
+    elif id_type == "person":
+        values = emails
+    else:
+        raise ValueError("unknown id_type: {}".format(id_type))
+
+    if n_processes is None:
+        return map_in_chunks(values=values,
+                             fn=_make_id,
+                             dtype=object,
+                             chunk_size=chunk_size)
+
+    if hasattr(values, "tolist"):
+        values = values.tolist()
+    else:
+        values = list(values)
+    unique = list(set(value for value in values
+                      if isinstance(value, str)))
+    chunks = [unique[i:i + chunk_size]
+              for i in range(0, len(unique), chunk_size)]
+    ids = dict()
+    with ProcessPoolExecutor(max_workers=n_processes) as pool:
+        for chunk, hashed in zip(chunks, pool.map(_make_ids, chunks)):
+            ids.update(zip(chunk, hashed))
+    # imported here, see `map_in_chunks`
+    import numpy as np
+    return np.array([ids[value] if isinstance(value, str) else None
+                     for value in values],
+                    dtype=object)
+
+
 def insert_one_to_bq(bq_client=None, dataset=None, table=None,
                      schema=None, payload=None, payload_type=None):
     """Utility function for inserting json rows into the specified
     table."""
     print("insert_one_to_bq()")
 
+    # the page cache found nothing new on the page, so the row we'd
+    # write is already in BQ
+    if payload_type == "crawler" and payload.get("page_unchanged") is True:
+        print("skipping unchanged page: {}".format(payload["url"]))
+        return "success: {}".format(True)
+
     # we may encounter an error when parsing html for wp plugins and
     # themes
     if payload_type == "wordpress_error":
@@ -456,7 +919,9 @@ def insert_one_to_bq(bq_client=None, dataset=None, table=None,
                 payload["tier2_classification"],
                 payload["tier3_classification"],
                 payload["classification_confidence"],
-                payload["html_string"]
+                payload["html_string"],
+                payload["html_sha256"],
+                payload["html_bytes"]
             )
         ]
 
@@ -678,39 +1143,16 @@ def insert_one_to_bq(bq_client=None, dataset=None, table=None,
     return "success: {}".format(success)
 
 
-def insert_many_to_bq(bq_client=None, dataset=None, table=None,
-                      schema=None, payload=None, payload_type=None):
-    """Utility function for inserting json rows into the specified
-    table."""
-    print("insert_many_to_bq()")
-
-    # configs for bq
-    # client = bq.Client()
-    # job_config = bq.LoadJobConfig()
-    # job_config.schema = schema
-    # job_config.source_format = \
-    #     bq.job.SourceFormat.NEWLINE_DELIMITED_JSON
-    # job_config.write_disposition = \
-    #     bq.job.WriteDisposition.WRITE_APPEND
-
-    dataset_ref = bq_client.dataset(dataset)
-    dataset = bq.Dataset(dataset_ref)
-    table_ref = dataset.table(table)
-    table = bq.Table(table_ref,
-                     schema=schema)
-
-    print("dataset: {}".format(dataset))
-    print("table: {}".format(table))
-    print("schema: {}".format(schema))
-    print("payload: {}".format(payload))
-    print("payload type: {}".format(payload_type))
-
+def make_many_bq_rows(payload=None, payload_type=None):
+    """Utility function that flattens a payload into the rows for the
+    one-to-many tables."""
+    rows = list()
     if payload_type == "wordpress_assets":
         keys = payload.keys()
         if "wp_themes" in keys:
             print("inserting wordpress themes.")
             for theme in payload["wp_themes"]:
-                row = [
+                rows.append(
                     (
                         payload["refinery_company_id"],
                         payload["refined_at"],
@@ -719,36 +1161,12 @@ def insert_many_to_bq(bq_client=None, dataset=None, table=None,
                         "theme",
                         payload["document"]
                     )
-                ]
-
-                max_retries = 7
-                for n in range(max_retries):
-                    try:
-                        # attempt to insert the record
-                        errors = bq_client.insert_rows(
-                            table,
-                            row,
-                            selected_fields=schema,
-
-                        )
-
-                        if len(errors) != 0:
-                            print(errors)
-                            continue
-                        success = True
-                        break
-                    except Exception as e:
-                        if n == max_retries - 1:
-                            print(e)
-                            success = False
-                            break
-                        time.sleep(2 ** n)
-                        continue
+                )
 
         if "wp_plugins" in keys:
             print("inserting wordpress plugins.")
             for plugin in payload["wp_plugins"]:
-                row = [
+                rows.append(
                     (
                         payload["refinery_company_id"],
                         payload["refined_at"],
@@ -757,36 +1175,12 @@ def insert_many_to_bq(bq_client=None, dataset=None, table=None,
                         "plugin",
                         payload["document"]
                     )
-                ]
-
-                max_retries = 7
-                for n in range(max_retries):
-                    try:
-                        # attempt to insert the record
-                        errors = bq_client.insert_rows(
-                            table,
-                            row,
-                            selected_fields=schema,
-
-                        )
-
-                        if len(errors) != 0:
-                            print(errors)
-                            continue
-                        success = True
-                        break
-                    except Exception as e:
-                        if n == max_retries - 1:
-                            print(e)
-                            success = False
-                            break
-                        time.sleep(2 ** n)
-                        continue
+                )
 
     if payload_type == "clearbit_emails":
+        print("inserting emails.")
         for email in payload["emails"]:
-            print("inserting emails.")
-            row = [
+            rows.append(
                 (
                     payload["refinery_company_id"],
                     payload["refined_at"],
@@ -797,36 +1191,12 @@ def insert_many_to_bq(bq_client=None, dataset=None, table=None,
                     payload["fuzzy_match"],
                     email
                 )
-            ]
-
-            max_retries = 7
-            for n in range(max_retries):
-                try:
-                    # attempt to insert the record
-                    errors = bq_client.insert_rows(
-                        table,
-                        row,
-                        selected_fields=schema,
-
-                    )
-
-                    if len(errors) != 0:
-                        print(errors)
-                        continue
-                    success = True
-                    break
-                except Exception as e:
-                    if n == max_retries - 1:
-                        print(e)
-                        success = False
-                        break
-                    time.sleep(2 ** n)
-                    continue
+            )
 
     if payload_type == "clearbit_phones":
+        print("inserting phones.")
         for phone in payload["phones"]:
-            print("inserting phones.")
-            row = [
+            rows.append(
                 (
                     payload["refinery_company_id"],
                     payload["refined_at"],
@@ -837,35 +1207,12 @@ def insert_many_to_bq(bq_client=None, dataset=None, table=None,
                     payload["fuzzy_match"],
                     phone
                 )
-            ]
-            max_retries = 7
-            for n in range(max_retries):
-                try:
-                    # attempt to insert the record
-                    errors = bq_client.insert_rows(
-                        table,
-                        row,
-                        selected_fields=schema,
-
-                    )
-
-                    if len(errors) != 0:
-                        print(errors)
-                        continue
-                    success = True
-                    break
-                except Exception as e:
-                    if n == max_retries - 1:
-                        print(e)
-                        success = False
-                        break
-                    time.sleep(2 ** n)
-                    continue
+            )
 
     if payload_type == "clearbit_tags":
+        print("inserting tags.")
         for tag in payload["tags"]:
-            print("inserting tags.")
-            row = [
+            rows.append(
                 (
                     payload["refinery_company_id"],
                     payload["refined_at"],
@@ -876,36 +1223,12 @@ def insert_many_to_bq(bq_client=None, dataset=None, table=None,
                     payload["fuzzy_match"],
                     tag
                 )
-            ]
-
-            max_retries = 7
-            for n in range(max_retries):
-                try:
-                    # attempt to insert the record
-                    errors = bq_client.insert_rows(
-                        table,
-                        row,
-                        selected_fields=schema,
-
-                    )
-
-                    if len(errors) != 0:
-                        print(errors)
-                        continue
-                    success = True
-                    break
-                except Exception as e:
-                    if n == max_retries - 1:
-                        print(e)
-                        success = False
-                        break
-                    time.sleep(2 ** n)
-                    continue
+            )
 
     if payload_type == "clearbit_tech":
+        print("inserting tech.")
         for tech in payload["tech"]:
-            print("inserting tech.")
-            row = [
+            rows.append(
                 (
                     payload["refinery_company_id"],
                     payload["refined_at"],
@@ -916,36 +1239,12 @@ def insert_many_to_bq(bq_client=None, dataset=None, table=None,
                     payload["fuzzy_match"],
                     tech
                 )
-            ]
-
-            max_retries = 7
-            for n in range(max_retries):
-                try:
-                    # attempt to insert the record
-                    errors = bq_client.insert_rows(
-                        table,
-                        row,
-                        selected_fields=schema,
-
-                    )
-
-                    if len(errors) != 0:
-                        print(errors)
-                        continue
-                    success = True
-                    break
-                except Exception as e:
-                    if n == max_retries - 1:
-                        print(e)
-                        success = False
-                        break
-                    time.sleep(2 ** n)
-                    continue
+            )
 
     if payload_type == "wp_lookup":
         print("updating wp plugin lookup table.")
         for tag in payload["tags"]:
-            row = [
+            rows.append(
                 (
                     payload["plugin"],
                     payload["refined_at"],
@@ -954,37 +1253,13 @@ def insert_many_to_bq(bq_client=None, dataset=None, table=None,
                     tag,
                     payload["description"]
                 )
-            ]
-
-            max_retries = 7
-            for n in range(max_retries):
-                try:
-                    # attempt to insert the record
-                    errors = bq_client.insert_rows(
-                        table,
-                        row,
-                        selected_fields=schema,
-
-                    )
-
-                    if len(errors) != 0:
-                        print(errors)
-                        continue
-                    success = True
-                    break
-                except Exception as e:
-                    if n == max_retries - 1:
-                        print(e)
-                        success = False
-                        break
-                    time.sleep(2 ** n)
-                    continue
+            )
 
     if payload_type == "email_provider":
         print("inserting email provider lookup results.")
         for email_provider, mx_record in zip(
                 payload["email_providers"], payload["mx_records"]):
-            row = [
+            rows.append(
                 (
                     payload["refinery_company_id"],
                     payload["refined_at"],
@@ -993,30 +1268,52 @@ def insert_many_to_bq(bq_client=None, dataset=None, table=None,
                     mx_record,
                     email_provider
                 )
-            ]
+            )
+    return rows
 
-            max_retries = 7
-            for n in range(max_retries):
-                try:
-                    # attempt to insert the record
-                    errors = bq_client.insert_rows(
-                        table,
-                        row,
-                        selected_fields=schema,
 
-                    )
+def insert_many_to_bq(bq_client=None, dataset=None, table=None,
+                      schema=None, payload=None, payload_type=None,
+                      writer=None):
+    """Utility function for inserting json rows into the specified
+    table.
+
+    `payload` may be a single payload or a list of payloads. Rows are
+    streamed in batches; pass a shared `BatchedRowWriter` as `writer`
+    to buffer rows across calls and `flush()` it once at the end of
+    the invocation."""
+    print("insert_many_to_bq()")
 
-                    if len(errors) != 0:
-                        print(errors)
-                        continue
-                    success = True
-                    break
-                except Exception as e:
-                    if n == max_retries - 1:
-                        print(e)
-                        success = False
-                        break
-                    time.sleep(2 ** n)
-                    continue
+    dataset_ref = bq_client.dataset(dataset)
+    dataset = bq.Dataset(dataset_ref)
+    table_ref = dataset.table(table)
+    table = bq.Table(table_ref,
+                     schema=schema)
 
+    print("dataset: {}".format(dataset))
+    print("table: {}".format(table))
+    print("schema: {}".format(schema))
+    print("payload: {}".format(payload))
+    print("payload type: {}".format(payload_type))
+
+    if isinstance(payload, list):
+        payloads = payload
+    else:
+        payloads = [payload]
+
+    flush = False
+    if writer is None:
+        writer = BatchedRowWriter(bq_client=bq_client)
+        flush = True
+
+    for p in payloads:
+        writer.add_rows(table=table,
+                        schema=schema,
+                        rows=make_many_bq_rows(payload=p,
+                                               payload_type=payload_type))
+
+    if flush is True:
+        success = writer.flush()
+    else:
+        success = writer.rows_failed == 0
     return "success: {}".format(success)
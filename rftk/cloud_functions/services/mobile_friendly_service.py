@@ -8,7 +8,9 @@ import time
 
 import requests
 
+from .constants import MOBILE_FRIENDLY_TIMEOUT
 from .crawler_service import HEADERS
+from .sessions import get_session
 
 
 # TODO: this needs more thorough investigation/testing to see how/why
@@ -30,10 +32,11 @@ def check_mobile_friendly(request=None):
     i = 0
     while success is False and i < 5:
         try:
-            resp = requests.post(
+            resp = get_session("google").post(
                 url=api_url,
                 headers=HEADERS,
-                json=json_data
+                json=json_data,
+                timeout=MOBILE_FRIENDLY_TIMEOUT
             )
             resp.raise_for_status()
 
@@ -45,6 +48,11 @@ def check_mobile_friendly(request=None):
             i += 1
             resp = str(e.response.status_code)
             continue
+        # timeouts and connection errors are retried too
+        except requests.exceptions.RequestException as e:
+            print("attempt {} failed: {!r}".format(i + 1, e))
+            i += 1
+            continue
 
     if success is True:
         resp_ = {
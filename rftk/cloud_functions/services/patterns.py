@@ -0,0 +1,57 @@
+"""
+patterns.py: Precompiled regular expressions shared by the services.
+
+Patterns are compiled once at import instead of being rebuilt (or looked
+up in the `re` cache) on every call in the extractors and validators.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import re
+
+
+# crawler_service
+EMAIL_TEXT_RE = re.compile(r"'<\S+?>'")
+PHONE_RE = re.compile(
+    r'(?:(?:\+?([1-9]|[0-9][0-9]|[0-9][0-9][0-9])'
+    r'\s*(?:[.-]\s*)?)?(?:\(\s*([2-9]1[02-9]|[2-9][02-8]1|[2-9]'
+    r'[02-8][02-9])\s*\)|([0-9][1-9]|[0-9]1[02-9]|[2-9][02-8]1|'
+    r'[2-9][02-8][02-9]))\s*(?:[.-]\s*)?)?([2-9]1[02-9]|[2-9]'
+    r'[02-9]1|[2-9][02-9]{2})\s*(?:[.-]\s*)?([0-9]{4})(?:\s*'
+    r'(?:#|x\.?|ext\.?|extension)\s*(\d+))?'
+)
+WP_PLUGIN_RE = re.compile(r"""(?<=wp-content\/plugins\/)(.*?)(?=\/)""")
+WP_THEME_RE = re.compile(r"""(?<=wp-content\/themes\/)(.*?)(?=\/)""")
+SQUARESPACE_CONTEXT_RE = re.compile(
+    r"(?ms)Static\.SQUARESPACE_CONTEXT = ({.+?});")
+EXTERNAL_LINK_RE = re.compile(
+    r"(http|ftp|https)://([\w_-]+(?:(?:\.[\w_-]+)+))"
+    r"([\w.,@?^=%&:/~+#-]*[\w@?^=%&/~+#-])?"
+)
+# charset in a content-type header and in a <meta> tag
+CHARSET_RE = re.compile(r"""(?i)charset\s*=\s*["']?([\w.:-]+)""")
+META_CHARSET_RE = re.compile(
+    rb"""(?i)<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""")
+
+# wordpress_lookup_service
+README_NAME_RE = re.compile(r"(?m)^===\s*(.+?)\s*=")
+README_TAGS_RE = re.compile(r"(?m)^Tags:\s*(.+?)\r?$")
+README_DESCRIPTION_RE = re.compile(r"(?ms)^== Description ==\s*(.+?)\s+^=")
+
+# email_provider_lookup_service
+MX_PRIORITY_RE = re.compile(r"\d+\s")
+
+# functions
+# source: https://stackoverflow.com/questions/201323/how-to-validate-an-email-address-using-a-regular-expression
+# NOTE: kept as the original non-raw literal (with its invalid escapes
+# doubled) so the compiled pattern is unchanged
+EMAIL_RE = re.compile(
+    """(?:[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*|"(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21\x23-\x5b\x5d-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])*")@(?:(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?|\\[(?:(?:(2(5[0-5]|[0-4][0-9])|1[0-9][0-9]|[1-9]?[0-9]))\\.){3}(?:(2(5[0-5]|[0-4][0-9])|1[0-9][0-9]|[1-9]?[0-9])|[a-z0-9-]*[a-z0-9]:(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21-\x5a\x53-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])+)\\])"""
+)
+EMAIL_DOMAIN_RE = re.compile(r"^(.*@)([\w.]+)")
+
+# envelope
+# orjson decodes ints outside the 64-bit range as floats
+LONG_DIGITS_RE = re.compile(rb"\d{19,}")
+
+# classifiers
+TOKEN_RE = re.compile(r"[a-z0-9]{2,}")
@@ -0,0 +1,163 @@
+"""
+rate_limits.py: Adaptive rate limiting driven by the rate limit headers
+an API returns with every response.
+
+The limiter spreads the requests left in the current window evenly over
+the time left until it resets, so callers are paced ahead of time
+instead of running into the limit and sleeping until the reset.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# only needed by the file backend
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .classes import MetadataMixin, LatencyHistogram
+from .constants import CLEARBIT_RATE_LIMIT, CLEARBIT_RATE_LIMIT_FILE, \
+    RATE_LIMIT_RESET_MARGIN
+
+
+class MemoryLimiterState(object):
+    """Limiter state shared by the threads of a single process."""
+    def __init__(self):
+        self._state = dict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield self._state
+
+
+class FileLimiterState(object):
+    """Limiter state kept in a local JSON file and locked with `flock`,
+    so every worker process on the machine shares one budget."""
+    def __init__(self, path=None):
+        if fcntl is None:
+            raise ValueError("the file backend requires `fcntl`")
+        self.path = path
+
+    @contextmanager
+    def transaction(self):
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                state = json.loads(raw) if len(raw) != 0 else dict()
+                yield state
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class AdaptiveRateLimiter(object):
+    """Paces requests from the `x-ratelimit-remaining` and
+    `x-ratelimit-reset` headers.
+
+    `update` records the budget reported by each response; `reserve`
+    hands out the next request slot, `remaining` slots spread evenly up
+    to the reset, and returns how long to wait for it. Until a response
+    has been seen requests are paced at `default_rate` per second."""
+    def __init__(self, state=None, default_rate=CLEARBIT_RATE_LIMIT,
+                 reset_margin=RATE_LIMIT_RESET_MARGIN):
+        self.state = MemoryLimiterState() if state is None else state
+        self.default_rate = default_rate
+        self.reset_margin = reset_margin
+        self.waits = LatencyHistogram()
+
+    def update(self, headers=None):
+        """Records the rate limit headers of a response."""
+        remaining = headers.get("x-ratelimit-remaining")
+        reset = headers.get("x-ratelimit-reset")
+        if remaining is None or reset is None:
+            return
+        remaining = int(remaining)
+        reset = float(reset)
+        # the reset is an epoch timestamp; small values are taken to be
+        # seconds until the reset
+        if reset < 1e9:
+            reset += time.time()
+        with self.state.transaction() as state:
+            # responses from the same window can arrive out of order so
+            # keep the lowest count
+            if state.get("reset_at") == reset and \
+                    state.get("remaining") is not None:
+                remaining = min(remaining, state["remaining"])
+            state["remaining"] = remaining
+            state["reset_at"] = reset
+
+    def reserve(self, max_wait=None):
+        """Takes the next request slot and returns the seconds to wait
+        for it. If that's more than `max_wait` seconds no slot is taken
+        and None is returned."""
+        now = time.time()
+        with self.state.transaction() as state:
+            slot = max(now, state.get("next_at", now))
+            remaining = state.get("remaining")
+            reset_at = state.get("reset_at")
+            left = None
+            if remaining is None or reset_at is None or reset_at <= slot:
+                # nothing is known about the current window
+                interval = 1.0 / self.default_rate
+            elif remaining <= 0:
+                # out of requests; hold everyone until the reset
+                slot = reset_at + self.reset_margin
+                interval = 1.0 / self.default_rate
+            else:
+                interval = (reset_at - slot) / remaining
+                left = remaining - 1
+            if max_wait is not None and slot - now > max_wait:
+                # leave the slot for a caller that can wait for it
+                return None
+            if left is not None:
+                state["remaining"] = left
+            state["next_at"] = slot + interval
+        wait = max(slot - now, 0.0)
+        self.waits.record(wait)
+        return wait
+
+    def acquire(self, timeout=None):
+        """Blocks until the next request slot. Returns the seconds
+        waited, or None without waiting if the slot is more than
+        `timeout` seconds away."""
+        wait = self.reserve(max_wait=timeout)
+        if wait is not None and wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def get_stats(self):
+        """Returns the last reported budget and the waits so far."""
+        with self.state.transaction() as state:
+            stats = MetadataMixin(
+                remaining=state.get("remaining"),
+                reset_at=state.get("reset_at")
+            )
+        stats["wait"] = self.waits.get_stats()
+        return stats
+
+
+_RATE_LIMITER = None
+_RATE_LIMITER_LOCK = threading.Lock()
+
+
+def get_rate_limiter(path=CLEARBIT_RATE_LIMIT_FILE):
+    """Returns the process-wide Clearbit rate limiter. With a `path`
+    (`RFTK_CLEARBIT_RATE_LIMIT_FILE`) its state is shared through that
+    file with the other processes on the machine."""
+    global _RATE_LIMITER
+    with _RATE_LIMITER_LOCK:
+        if _RATE_LIMITER is None:
+            state = None if path is None else FileLimiterState(path=path)
+            _RATE_LIMITER = AdaptiveRateLimiter(state=state)
+    return _RATE_LIMITER
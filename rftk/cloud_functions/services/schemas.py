@@ -255,6 +255,13 @@ CRAWLER_DOMAIN_SCHEMA = [
     bq.SchemaField(name="html_string",
                    field_type="string",
                    mode="nullable"),
+    # the raw html is stored compressed in gcs under this digest
+    bq.SchemaField(name="html_sha256",
+                   field_type="string",
+                   mode="nullable"),
+    bq.SchemaField(name="html_bytes",
+                   field_type="integer",
+                   mode="nullable"),
 ]
 
 # clearbit person
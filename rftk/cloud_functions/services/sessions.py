@@ -0,0 +1,90 @@
+"""
+sessions.py: Pooled HTTP sessions shared by the outbound fetchers, and
+the GCS filesystems shared by the services.
+
+Sessions live at module level so warm Cloud Function invocations reuse
+the open keep-alive connections instead of paying for a new TCP+TLS
+handshake on every request.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .constants import HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE
+
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+# project -> GCS filesystem
+_FS_CLIENTS = dict()
+_FS_CLIENTS_LOCK = threading.Lock()
+
+
+def make_session(pool_connections=HTTP_POOL_CONNECTIONS,
+                 pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0):
+    """Utility function that creates a session whose adapters keep a
+    connection pool per host."""
+    print("make_session()")
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          max_retries=max_retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(name="default", pool_connections=HTTP_POOL_CONNECTIONS,
+                pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0):
+    """Returns the named session from the registry, creating it on
+    first use. The pool settings only apply when the session is
+    created."""
+    session = _SESSIONS.get(name)
+    if session is None:
+        with _SESSIONS_LOCK:
+            session = _SESSIONS.get(name)
+            if session is None:
+                session = make_session(
+                    pool_connections=pool_connections,
+                    pool_maxsize=pool_maxsize,
+                    max_retries=max_retries
+                )
+                _SESSIONS[name] = session
+    return session
+
+
+def close_sessions():
+    """Closes every session in the registry and its pooled
+    connections."""
+    print("close_sessions()")
+    with _SESSIONS_LOCK:
+        for session in _SESSIONS.values():
+            session.close()
+        _SESSIONS.clear()
+
+
+def get_fs_client(project_name=None):
+    """Utility function that returns the process-wide GCS filesystem
+    for the project, connecting on first use."""
+    with _FS_CLIENTS_LOCK:
+        if project_name not in _FS_CLIENTS:
+            # imported here as it's slow to import and only needed to
+            # read secrets and claim-checks
+            import gcsfs
+            fs = gcsfs.GCSFileSystem(
+                project=project_name,
+                access="full_control",
+                token="cloud",
+                # consistency="md5",
+                cache_timeout=None,
+                secure_serialize=True,
+                check_connection=True
+            )
+
+            fs.retries = 7
+            fs.connect(method="cloud")
+            _FS_CLIENTS[project_name] = fs
+    return _FS_CLIENTS[project_name]
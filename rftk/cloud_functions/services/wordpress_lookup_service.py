@@ -4,12 +4,14 @@ lookup service.
 """
 __author__ = "Jason Wolosonovich <jason@avaland.io>"
 __license__ = "BSD 3 Clause"
-import re
-
 import requests
-from bs4 import BeautifulSoup
 
-from .crawler_service import HEADERS
+from .constants import HTTP_TIMEOUT
+from .crawler_service import HEADERS, parse_html, get_document_index, \
+    get_charset
+from .patterns import README_NAME_RE, README_TAGS_RE, \
+    README_DESCRIPTION_RE
+from .sessions import get_session
 
 
 def get_wp_plugin_info_online(plugin=None):
@@ -19,10 +21,13 @@ def get_wp_plugin_info_online(plugin=None):
     plugin_url = "http://plugins.svn.wordpress.org/{}/trunk/" \
         .format(plugin)
     try:
-        r = requests.get(url=plugin_url,
-                         headers=HEADERS)
-    except requests.exceptions.HTTPError as e:
+        r = get_session("wordpress").get(url=plugin_url,
+                                         headers=HEADERS,
+                                         timeout=HTTP_TIMEOUT)
+    # timeouts and connection errors as well as http errors
+    except requests.exceptions.RequestException as e:
         print(e)
+        return list(), None, None
 
     if r.status_code != 200:
         description = None
@@ -31,42 +36,43 @@ def get_wp_plugin_info_online(plugin=None):
     else:
         # check for the text file as they're potentially named
         # differently
-        soup = BeautifulSoup(r.content,
-                             "html.parser")
+        document = parse_html(
+            content=r.content,
+            encoding=get_charset(r.headers.get("content-type"))
+        )
 
         # find the link with .txt and follow it
-        txt_href = soup.select_one("a[href*=.txt]")
+        txt_hrefs = [href for href in
+                     get_document_index(document).anchors
+                     if ".txt" in href]
 
-        if txt_href is None:
+        if len(txt_hrefs) == 0:
             return list(), None, None
         else:
-            txt_href = txt_href.text
+            txt_href = txt_hrefs[0]
 
         # now visit that and parse the description
         try:
             readme_url = plugin_url + txt_href
-            r = requests.get(url=readme_url,
-                             headers=HEADERS)
-        except requests.exceptions.HTTPError as e:
+            r = get_session("wordpress").get(url=readme_url,
+                                             headers=HEADERS,
+                                             timeout=HTTP_TIMEOUT)
+        except requests.exceptions.RequestException as e:
             print(e)
+            return list(), None, None
 
         if r.status_code != 200:
             description = None
             tags = list()
             name = None
         else:
-            name_re = r"(?m)^===\s*(.+?)\s*="
-            tags_re = r"(?m)^Tags:\s*(.+?)\r?$"
-            d_re = r"(?ms)^== Description ==\s*(.+?)\s+^="
             try:
-                name = re.search(name_re,
-                                 r.text).group(1)
+                name = README_NAME_RE.search(r.text).group(1)
                 name = name.replace("\r", " ").replace("\n", " ")
             except AttributeError as e:
                 name = None
             try:
-                tags = re.search(tags_re,
-                                 r.text)\
+                tags = README_TAGS_RE.search(r.text)\
                 .group(1)\
                 .split(",")
                 tags = [tag.replace("\r", "").replace("\n", "")
@@ -74,8 +80,7 @@ def get_wp_plugin_info_online(plugin=None):
             except AttributeError as e:
                 tags = list()
             try:
-                description = re.search(d_re,
-                                        r.text).group(1)
+                description = README_DESCRIPTION_RE.search(r.text).group(1)
 
                 description = description.replace("\r", " ").replace(
                     "\n", " ")
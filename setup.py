@@ -45,6 +45,7 @@ setup(name="the_refinery_toolkit",
           "grpcio==1.16.0",
           "httplib2==0.11.3",
           "idna==2.7",
+          "numpy==1.15.4",
           "oauthlib==2.1.0",
           "protobuf==3.6.1",
           "psutil==5.4.7",
@@ -60,6 +61,22 @@ setup(name="the_refinery_toolkit",
           "urllib3==1.24",
           "validators==0.12.2"
       ],
+      extras_require={
+          # optional html parser backends for the crawler
+          "parsers": [
+              "lxml>=4.2.5",
+              "selectolax>=0.1.8"
+          ],
+          # zstd instead of gzip for stored html and pubsub messages
+          "compression": [
+              "zstandard>=0.10.1"
+          ],
+          # faster codecs for pubsub messages
+          "messages": [
+              "orjson>=2.0.0",
+              "msgpack>=0.5.6"
+          ]
+      },
       classifiers=[
           "Development Status :: 3 - Alpha",
           # "Programming Language :: Python :: 2",
@@ -0,0 +1,63 @@
+"""
+test_crawler_service.py: Deadlines on page downloads.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import socket
+import threading
+import time
+
+import pytest
+import requests
+
+from rftk.cloud_functions.services.crawler_service import fetch_html
+
+
+def serve_slowly(n_bytes=10, interval=0.5):
+    """Starts a server that trickles out an html body a byte every
+    `interval` seconds and returns its url."""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(5)
+
+    def handle(conn):
+        try:
+            conn.recv(65536)
+            conn.sendall(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/html\r\n"
+                         b"Content-Length: " + str(n_bytes).encode() +
+                         b"\r\n\r\n")
+            for _ in range(n_bytes):
+                time.sleep(interval)
+                conn.sendall(b"a")
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=(conn,),
+                             daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return "http://127.0.0.1:{}/".format(server.getsockname()[1])
+
+
+def test_deadline_cuts_off_slow_server():
+    # each byte arrives well within the read timeout, but the whole body
+    # takes 5 seconds
+    url = serve_slowly(n_bytes=10, interval=0.5)
+    start = time.time()
+    with pytest.raises(requests.exceptions.Timeout):
+        fetch_html(url=url, deadline=time.time() + 1.0)
+    assert time.time() - start < 2.0
+
+
+def test_deadline_leaves_fast_server_alone():
+    url = serve_slowly(n_bytes=3, interval=0.05)
+    status_code, content, _ = fetch_html(url=url,
+                                         deadline=time.time() + 5.0)
+    assert status_code == 200
+    assert content == b"aaa"
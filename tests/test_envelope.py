@@ -0,0 +1,35 @@
+"""
+test_envelope.py: Round trips through the Pub/Sub message envelope.
+"""
+__author__ = "Jason Wolosonovich <jason@avaland.io>"
+__license__ = "BSD 3 clause"
+import json
+import math
+
+from rftk.cloud_functions.services.envelope import encode_message, \
+    decode_message, dumps, loads
+
+
+def test_big_int_round_trip():
+    message = {"topic": "t", "id": 2 ** 70, "negative": -2 ** 70}
+    data, attributes = encode_message(message=message, codec="json")
+    assert decode_message(data=data, attributes=attributes) == message
+    assert loads(data=dumps(message=message)) == message
+
+
+def test_big_int_without_attributes():
+    # bodies from producers that don't use the envelope yet
+    data = json.dumps({"id": 2 ** 70}).encode()
+    decoded = decode_message(data=data)
+    assert isinstance(decoded["id"], int)
+    assert decoded["id"] == 2 ** 70
+
+
+def test_non_finite_floats():
+    data = json.dumps({"x": float("nan"), "y": float("inf")}).encode()
+    decoded = decode_message(data=data)
+    assert math.isnan(decoded["x"])
+    assert decoded["y"] == float("inf")
+    decoded = loads(data=dumps(message={"x": float("nan"), "y": None}))
+    assert math.isnan(decoded["x"])
+    assert decoded["y"] is None